@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Times DarwinParser's SAX and expat backends, and expat on a reused parser, over a gzipped pushport capture (the
+format incorporate_ftp consumes) and/or a Knowledgebase stations XML document, checking first that they all agree on
+every document
+
+Usage: benchmarks/parsing.py [--pushport capture.gz] [--kb stations.xml] [--repeats N]"""
+
+import sys, os, io, gzip, argparse, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ironswallow.darwin import parse, kb_consts
+
+
+def darwin_parser() -> parse.DarwinParser:
+    return parse.DarwinParser(parse.DARWIN_PATHS, parse.DARWIN_DETOKENISE, folded_list=parse.DARWIN_NAMED_LIST_PATHS)
+
+
+def kb_parser() -> parse.DarwinParser:
+    return parse.DarwinParser(include_tags=False, folded_list=kb_consts.FOLD_LISTS, exclude_data=kb_consts.EXCLUDE_DATA,
+                              collapse_data=kb_consts.FLAT_DATA, collapse_data_types=kb_consts.DATA_TYPES)
+
+
+BACKENDS = (
+    ("sax", lambda parser, data: parser().parse(io.StringIO(data.decode("utf8")))),
+    ("expat", lambda parser, data: parser().parse_bytes(data)),
+    ("reused", lambda parser, data: parse.pooled_parser(parser, parser).parse_bytes(data)),
+)
+
+
+def run(name, parser, documents, count, unit, repeats) -> None:
+    for n, document in enumerate(documents):
+        results = [backend(parser, document) for _, backend in BACKENDS]
+        if any([a != results[0] for a in results]):
+            raise AssertionError("{} document {} differs between backends".format(name, n))
+
+    for backend_name, backend in BACKENDS:
+        seconds = min(timeit.repeat(lambda: [backend(parser, a) for a in documents], number=1, repeat=repeats))
+        print("{:10} {:6} {:8.3f}s  {:10.1f} {}/s  {:8.1f} us/{}".format(
+            name, backend_name, seconds, count/seconds, unit, seconds/count*1e6, unit))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pushport")
+    parser.add_argument("--kb")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.pushport:
+        with gzip.open(args.pushport) as f:
+            messages = [a for a in f if a.strip()]
+        run("pushport", darwin_parser, messages, len(messages), "msg", args.repeats)
+
+    if args.kb:
+        with open(args.kb, "rb") as f:
+            document = f.read()
+        run("kb", kb_parser, [document], len(document)/1024, "KiB", args.repeats)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Replays a gzipped pushport capture (the format incorporate_ftp consumes) through parse_pport and
+MessageProcessor.store against the database in secret.json/config.json, committing in batches the way the listener
+does, then reports throughput, batch latency from BEGIN until its COMMIT has run, how long statements queued and
+executed for by record tag, and rows written per table. Messages go in file order, so runs over the
+same capture and starting data are comparable. Point this at a scratch database, it writes as the live service would.
+
+Usage: benchmarks/replay.py capture.gz [--speed N] [--batch N] [--pool N] [--schedule-cache N] [--limit N]
+                                       [--metrics-port N]
+
+--speed replays at N times real time, going by each Pport's ts, by default it goes as fast as it can"""
+
+import sys, os, gzip, argparse, contextlib, time, itertools
+from typing import Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# store.darwin has to come first, it imports main, which imports the store package
+import ironswallow.store.darwin
+import main
+from ironswallow.darwin import parse
+from ironswallow.util import database, metrics
+from ironswallow.util.times import process_timestamp
+
+
+def load_reference(c) -> None:
+    """LOCATIONS and REASONS as incorporate_reference_data would have left them, from what it last stored"""
+    c.execute("SELECT tiploc, dict FROM darwin_locations;")
+    main.LOCATIONS.update({tiploc: location for tiploc, location in c.fetchall()})
+    c.execute("SELECT id, type, message FROM darwin_reasons;")
+    main.REASONS.update({(str(id_), type_): message for id_, type_, message in c.fetchall()})
+
+
+def table_stats(c) -> dict:
+    c.execute("SELECT pg_stat_clear_snapshot();")
+    c.execute("""SELECT relname, n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables
+        WHERE relname LIKE 'darwin\\_%' OR relname='last_received_sequence';""")
+    return {a[0]: a[1:] for a in c.fetchall()}
+
+
+def percentile(ordered, fraction) -> float:
+    return ordered[min(len(ordered)-1, int(fraction*len(ordered)))] if ordered else float("nan")
+
+
+def bucket_percentile(buckets, fraction) -> float:
+    """Upper bound of the metrics bucket the percentile falls in"""
+    wanted, cumulative = fraction*sum(buckets), 0
+    for bound, bucket_count in zip(metrics.BUCKETS + (float("inf"),), buckets):
+        cumulative += bucket_count
+        if cumulative and cumulative >= wanted:
+            return bound
+    return float("nan")
+
+
+def statement_stats() -> dict:
+    """(name, tag) -> count, mean and bucketed p50/p99, from the queue wait and execute histograms the executor keeps"""
+    with metrics._lock:
+        histograms = {k: (list(v[0]), v[1]) for k, v in metrics._histograms.items()}
+
+    stats = {}
+    for (name, labels), (buckets, total) in histograms.items():
+        if name in ("ironswallow_queue_wait_seconds", "ironswallow_execute_seconds"):
+            count = sum(buckets)
+            stats[(name, dict(labels).get("tag"))] = (count, total/count if count else float("nan"),
+                                                     bucket_percentile(buckets, 0.5), bucket_percentile(buckets, 0.99))
+    return stats
+
+
+def _committed(commit_times, began) -> None:
+    commit_times.append(time.perf_counter()-began)
+
+
+def replay(mp, path, speed=0, batch_size=100, limit=None) -> Tuple[list, list, list]:
+    """Returns the parse and queueing times for each message, and for each batch the time from queueing its BEGIN
+    until its COMMIT had been executed"""
+    parse_times, queue_times, commit_times = [], [], []
+    began = None
+    first_generated, started = None, time.perf_counter()
+
+    with gzip.open(path) as f:
+        lines = (a for a in f if a.strip())
+        for n, line in enumerate(itertools.islice(lines, limit)):
+            if n % batch_size == 0:
+                began = time.perf_counter()
+                mp.execute("BEGIN;", broadcast=True)
+
+            parse_started = time.perf_counter()
+            pport = parse.parse_pport(line)
+            records = parse.pport_records(pport)
+            parsed_at = time.perf_counter()
+
+            if speed:
+                generated = process_timestamp(pport.get("ts"))
+                if generated:
+                    first_generated = first_generated or generated
+                    ahead = (generated-first_generated).total_seconds()/speed - (parsed_at-started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+                        parsed_at = time.perf_counter()
+
+            mp.store(records)
+            parse_times.append(parsed_at-parse_started)
+            queue_times.append(time.perf_counter()-parsed_at)
+
+            if n % batch_size == batch_size-1:
+                mp.commit()
+                # Runs on the first shard, which only gets past a commit once every shard has
+                mp.call(_committed, commit_times, began)
+
+    if len(queue_times) % batch_size:
+        mp.commit()
+        mp.call(_committed, commit_times, began)
+    return parse_times, queue_times, commit_times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=0)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--pool", type=int, default=1)
+    parser.add_argument("--schedule-cache", type=int, default=50000)
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--metrics-port", type=int)
+    args = parser.parse_args()
+
+    metrics.serve(args.metrics_port)
+
+    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
+        load_reference(c)
+        c.execute("COMMIT;")
+        before = table_stats(c)
+        c.execute("COMMIT;")
+
+    with contextlib.ExitStack() as pool:
+        cursors = [pool.enter_context(pool.enter_context(database.DatabaseConnection()).new_cursor())
+                   for _ in range(args.pool)]
+
+        started = time.perf_counter()
+        with ironswallow.store.darwin.MessageProcessor(*cursors, schedule_cache_size=args.schedule_cache) as mp:
+            parse_times, queue_times, commit_times = replay(mp, args.capture, args.speed, args.batch, args.limit)
+            queued = time.perf_counter()
+        # Leaving the processor waits for everything queued to be executed
+        elapsed = time.perf_counter() - started
+
+    # Statistics are only reported once the writing connections are done with
+    time.sleep(1)
+    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
+        after = table_stats(c)
+
+    count = len(queue_times)
+    for times in (parse_times, queue_times, commit_times):
+        times.sort()
+    print("{} messages in {:.2f}s ({:.2f}s to queue), {:.1f} messages/s".format(
+        count, elapsed, queued-started, count/elapsed if elapsed else 0))
+    # queue is only how long store() took to hand a message's statements over, batch is what the database took
+    for name, times in (("parse", parse_times), ("queue", queue_times), ("batch", commit_times)):
+        print("{:6} p50 {:8.3f} ms  p99 {:8.3f} ms  max {:8.3f} ms".format(
+            name, percentile(times, 0.5)*1e3, percentile(times, 0.99)*1e3, (times or [float("nan")])[-1]*1e3))
+
+    print("{:12} {:16} {:>10} {:>10} {:>10} {:>10}".format("statements", "tag", "count", "mean ms", "p50 ms", "p99 ms"))
+    for (name, tag), (n, mean, p50, p99) in sorted(statement_stats().items(), key=lambda a: (a[0][0], str(a[0][1]))):
+        print("{:12} {:16} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            "waiting" if "queue" in name else "executing", str(tag), n, mean*1e3, p50*1e3, p99*1e3))
+
+    print("{:28} {:>10} {:>10} {:>10}".format("table", "inserted", "updated", "deleted"))
+    for table in sorted(after):
+        delta = [a-b for a, b in zip(after[table], before.get(table, (0, 0, 0)))]
+        if any(delta):
+            print("{:28} {:>10} {:>10} {:>10}".format(table, *delta))
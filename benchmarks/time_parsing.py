@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Compares the interned time parser against strptime, over the times in a gzipped pushport capture
+(the same format incorporate_ftp consumes)
+
+Usage: benchmarks/time_parsing.py capture.gz [repeats]"""
+
+import sys, os, gzip, datetime, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ironswallow.darwin import parse
+from ironswallow.util.times import process_time
+
+
+def strptime_time(time) -> datetime.time:
+    if not time:
+        return None
+    if len(time) == 5:
+        time += ":00"
+    return datetime.datetime.strptime(time, "%H:%M:%S").time()
+
+
+def collect_times(path) -> list:
+    out = []
+    with gzip.open(path) as f:
+        for line in f:
+            for record in parse.parse_darwin(line) or []:
+                if record["tag"] not in ("schedule", "TS"):
+                    continue
+                for location in record["list"]:
+                    out.extend([location[a] for a in ("pta", "wta", "wtp", "ptd", "wtd") if a in location])
+                    for forecast in [location[a] for a in ("arr", "pass", "dep") if a in location]:
+                        out.extend([forecast[a] for a in ("at", "et") if a in forecast])
+    return out
+
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    samples = collect_times(sys.argv[1])
+    assert [strptime_time(a) for a in samples] == [process_time(a) for a in samples]
+
+    print("{} times from {}".format(len(samples), sys.argv[1]))
+    for name, func in (("strptime", strptime_time), ("interned", process_time)):
+        best = min(timeit.repeat(lambda: [func(a) for a in samples], number=1, repeat=repeats))
+        print("{:10} {:8.3f}s  {:8.0f} ns/time".format(name, best, best/max(len(samples), 1)*1e9))
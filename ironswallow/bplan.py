@@ -1,108 +1,196 @@
-import csv, logging
+import csv, functools, hashlib, logging, os, pickle
 from datetime import datetime,timedelta
+from typing import Optional
 
-from sqlalchemy import PrimaryKeyConstraint, inspect
-from sqlalchemy.dialects.postgresql import insert
+import psycopg2.extras
+from sqlalchemy import inspect
 
 import ironswallow.util.database as database
+from ironswallow.util.pgcopy import copy_buffer
 from IronSwallowORM import models
 
 log = logging.getLogger("IronSwallow")
 
+BPLAN_PATH = "datasets/bplan.txt"
+
+# The hash of the BPlan file last merged into the database
+CREATE_VERSION_TABLE = """CREATE TABLE IF NOT EXISTS bplan_version (
+    sha256 CHAR(64) NOT NULL,
+    loaded TIMESTAMP NOT NULL
+);"""
+
+NWK_FIELDS = ("origin", "destination", "running_line_code", "running_line_desc", "start_date", "end_date",
+              "initial_direction", "final_direction", "distance", "doo_passenger", "doo_non_passenger", "retb", "zone",
+              "reversible", "power", "route_allowance")
+PLT_FIELDS = ("tiploc", "platform", "start_date", "end_date", "length", "power", "doo_passenger", "doo_non_passenger")
+REF_FIELDS = ("source", "locale", "code_type", "code", "description")
+
 BPLAN_NAMES = {}
 
 BPLAN_NETWORK_LOCATIONS = {}
 
 LOCALISED_OTHER_REFERENCES = []
 
-# TODO: eventually BPLAN will be updated - how are we going to remove retired data?
-def parse_store_bplan():
-    global BPLAN_NETWORK_LOCATIONS
-    log.info("Collecting BPlan")
 
-    with database.DatabaseConnection() as db_c:
-        #session = models.sessionmaker(bind=db_c.engine)()
-        bplan_nwk_batch = []
-        bplan_plt_batch = []
-        bplan_ref_batch = []
-
-        with open("datasets/bplan.txt", encoding="windows-1252") as tsv:
-            for line in csv.reader(tsv, delimiter="\t"):
-                if line[0] == "NWK":
-                    (record_type, action_code, origin_location, dest_location, running_line_code,
-                     running_line_desc, start_date, end_date, initial_direction, final_direction, distance,
-                     doo_p, doo_no_p, retb, zone, reversible, power, ra, max_tl) = line
-
-                    running_line_code = running_line_code.rstrip()
-                    running_line_desc = running_line_desc or None
-                    distance = int(distance) if distance else None
-
-                    # There are some with a time of 23:59:59. I hate it.
-                    start_date = (datetime.strptime(start_date, "%d-%m-%Y %H:%M:%S") + timedelta(seconds=1)).date() if start_date else None
-                    end_date = (datetime.strptime(end_date, "%d-%m-%Y %H:%M:%S") + timedelta(seconds=1)).date() if end_date else None
-                    doo_p = doo_p == "Y"
-                    doo_no_p = doo_no_p == "Y"
-                    retb = retb == "Y"
-
-                    bplan_nwk_batch.append(dict(origin=origin_location, destination=dest_location,
-                        running_line_code=running_line_code, running_line_desc=running_line_desc, start_date=start_date,
-                        end_date=end_date, initial_direction=initial_direction, final_direction=final_direction,
-                        distance=distance, doo_passenger=doo_p, doo_non_passenger=doo_no_p, retb=retb, zone=zone,
-                        reversible=reversible, power=power, route_allowance=ra))
-
-                    for tl in [origin_location, dest_location]:
-                        if tl not in BPLAN_NETWORK_LOCATIONS:
-                            BPLAN_NETWORK_LOCATIONS[tl] = set()
-                        BPLAN_NETWORK_LOCATIONS[tl] |= {running_line_code}
-
-                elif line[0] == "PLT":
-                    (record_type, action_code, tiploc, platform, start_date, end_date, length, power, doo_passenger,
-                     doo_non_passenger) = line
-
-                    platform = platform.rstrip() or None
-                    start_date = (datetime.strptime(start_date, "%d-%m-%Y %H:%M:%S") + timedelta(seconds=1)).date() if start_date else None
-                    end_date = (datetime.strptime(end_date, "%d-%m-%Y %H:%M:%S") + timedelta(seconds=1)).date() if end_date else None
-                    doo_passenger = doo_passenger == "Y"
-                    doo_non_passenger = doo_non_passenger == "Y"
-                    length = int(length) if length else None
-
-                    bplan_plt_batch.append(dict(tiploc=tiploc, platform=platform, start_date=start_date,
-                                                end_date=end_date, length=length, power=power,
-                                                doo_passenger=doo_passenger, doo_non_passenger=doo_non_passenger))
-
-                elif line[0] == "REF":
-                    (record_type, action_code, code_type, code, description) = line
-                    if code_type=="ACT":
-                        description = description[:52].rstrip()
-                    bplan_ref_batch.append(dict(source="BPLAN", locale="en_gb", code_type=code_type, code=code,
-                                                description=description))
-                    if code_type=="TOC":
-                        statement = insert(models.DarwinOperator.__table__)
-                        statement = statement.on_conflict_do_update(index_elements=(models.DarwinOperator.operator,),
-                                                                    set_={"operator_name": statement.excluded.operator_name})
-                        db_c.sa_connection.execute(statement, operator=code, operator_name=description, url=None,
-                                                   category="B")
-                elif line[0] == "LOC":
-                    (record_type, action_code, tiploc, location_name, start_date, end_date, os_east, os_north,
-                     tp_type, zone, stanox, off_network, force_lpb) = line
-
-                    end_date = (datetime.strptime(end_date, "%d-%m-%Y %H:%M:%S")) if end_date else None
-
-                    if not end_date or datetime.now() < end_date:
-                        BPLAN_NAMES[tiploc] = location_name
-
-        log.info("Merging BPlan")
-        statement = insert(models.BPlanNetworkLink.__table__).on_conflict_do_nothing()
-        db_c.sa_connection.execute(statement, bplan_nwk_batch)
-
-        statement = insert(models.BPlanPlatform.__table__).on_conflict_do_nothing()
-        db_c.sa_connection.execute(statement, bplan_plt_batch)
-
-        dictified_other_refs = [dict(source=a, locale=b, code_type=c, code=d, description=e) for a, b, c, d, e in LOCALISED_OTHER_REFERENCES]
-
-        statement = insert(models.LocalisedReference.__table__)
-        ref_pks = [key.name for key in inspect(models.LocalisedReference).primary_key]
-        statement = statement.on_conflict_do_update(index_elements=ref_pks, set_={"description": statement.excluded.description})
-        db_c.sa_connection.execute(statement, bplan_ref_batch + dictified_other_refs)
-
-        #session.commit()
+@functools.lru_cache(maxsize=None)
+def _timestamp(text) -> datetime:
+    # strptime is slow, and the same few thousand timestamps come up across tens of thousands of rows
+    return datetime(int(text[6:10]), int(text[3:5]), int(text[:2]), int(text[11:13]), int(text[14:16]), int(text[17:19]))
+
+
+def _date(text):
+    # There are some with a time of 23:59:59. I hate it.
+    return (_timestamp(text) + timedelta(seconds=1)).date() if text else None
+
+
+def read_bplan(path=BPLAN_PATH) -> dict:
+    """Rows for each table from the BPlan file, as tuples of the *_FIELDS above, and LOC rows as tiploc, name, end"""
+    nwk, plt, ref, toc, loc = [], [], [], {}, []
+
+    with open(path, encoding="windows-1252") as tsv:
+        for line in csv.reader(tsv, delimiter="\t"):
+            if line[0] == "NWK":
+                (record_type, action_code, origin_location, dest_location, running_line_code,
+                 running_line_desc, start_date, end_date, initial_direction, final_direction, distance,
+                 doo_p, doo_no_p, retb, zone, reversible, power, ra, max_tl) = line
+
+                nwk.append((origin_location, dest_location, running_line_code.rstrip(), running_line_desc or None,
+                            _date(start_date), _date(end_date), initial_direction, final_direction,
+                            int(distance) if distance else None, doo_p == "Y", doo_no_p == "Y", retb == "Y", zone,
+                            reversible, power, ra))
+
+            elif line[0] == "PLT":
+                (record_type, action_code, tiploc, platform, start_date, end_date, length, power, doo_passenger,
+                 doo_non_passenger) = line
+
+                plt.append((tiploc, platform.rstrip() or None, _date(start_date), _date(end_date),
+                            int(length) if length else None, power, doo_passenger == "Y", doo_non_passenger == "Y"))
+
+            elif line[0] == "REF":
+                (record_type, action_code, code_type, code, description) = line
+                if code_type=="ACT":
+                    description = description[:52].rstrip()
+                ref.append(("BPLAN", "en_gb", code_type, code, description))
+                if code_type=="TOC":
+                    toc[code] = description
+
+            elif line[0] == "LOC":
+                (record_type, action_code, tiploc, location_name, start_date, end_date, os_east, os_north,
+                 tp_type, zone, stanox, off_network, force_lpb) = line
+                loc.append((tiploc, location_name, _timestamp(end_date) if end_date else None))
+
+    return dict(nwk=nwk, plt=plt, ref=ref, toc=toc, loc=loc)
+
+
+def _remember(loc, network) -> None:
+    """Fill BPLAN_NAMES and BPLAN_NETWORK_LOCATIONS, which other modules hold on to, so they're updated in place"""
+    now = datetime.now()
+    BPLAN_NAMES.clear()
+    BPLAN_NAMES.update([(tiploc, name) for tiploc, name, end_date in loc if not end_date or now < end_date])
+    BPLAN_NETWORK_LOCATIONS.clear()
+    BPLAN_NETWORK_LOCATIONS.update(network)
+
+
+def _network_locations(nwk) -> dict:
+    network = {}
+    for row in nwk:
+        for tl in row[:2]:
+            network.setdefault(tl, set()).add(row[2])
+    return network
+
+
+def _merge(c, model, fields, rows, on_conflict="DO NOTHING", retire=None) -> None:
+    """Bring model's table into line with rows: they're COPYed into a staging table, rows in the table but not staged
+    are deleted (only those matching retire, if it's given), then staged rows not in the table are inserted. Rows are
+    compared whole, as text, so NULLs match and the comparison can be hashed"""
+    table = model.__table__
+    names = ", ".join(['"{}"'.format(table.columns[a].name) for a in fields])
+    staged_row = "ROW({})::text".format(", ".join(['s."{}"'.format(table.columns[a].name) for a in fields]))
+    table_row = "ROW({})::text".format(", ".join(['t."{}"'.format(table.columns[a].name) for a in fields]))
+
+    c.execute('CREATE TEMPORARY TABLE bplan_staging AS SELECT {} FROM "{}" WITH NO DATA;'.format(names, table.name))
+    c.copy_expert("COPY bplan_staging ({}) FROM STDIN;".format(names),
+                  copy_buffer(rows))
+    c.execute("ANALYZE bplan_staging;")
+
+    c.execute('DELETE FROM "{}" t WHERE {} NOT EXISTS (SELECT FROM bplan_staging s WHERE {} = {});'.format(
+        table.name, retire + " AND" if retire else "", staged_row, table_row))
+    retired = c.rowcount
+    c.execute('INSERT INTO "{0}" ({1}) SELECT DISTINCT {1} FROM bplan_staging s WHERE NOT EXISTS (SELECT FROM "{0}" t '
+              'WHERE {2} = {3}) ON CONFLICT {4};'.format(table.name, names, staged_row, table_row, on_conflict))
+    added = c.rowcount
+    c.execute("DROP TABLE bplan_staging;")
+
+    log.info("Merged {}, {} rows retired, {} added".format(table.name, retired, added))
+
+
+def _reference_conflict() -> str:
+    return "({}) DO UPDATE SET description=EXCLUDED.description".format(
+        ", ".join([key.name for key in inspect(models.LocalisedReference).primary_key]))
+
+
+def _load_cache(path, digest) -> Optional[tuple]:
+    try:
+        with open(path, "rb") as f:
+            cached = pickle.load(f)
+        if cached[0] == digest:
+            return cached[1:]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning("Ignoring unreadable BPlan cache: {}".format(e))
+    return None
+
+
+def _save_cache(path, digest, loc, network) -> None:
+    try:
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump((digest, loc, network), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        log.warning("Couldn't save BPlan cache: {}".format(e))
+
+
+def parse_store_bplan(path=BPLAN_PATH) -> None:
+    """Merge the BPlan file into the database, unless it's the one last merged, and fill BPLAN_NAMES and
+    BPLAN_NETWORK_LOCATIONS, from a cache next to the file if it was made from the same one"""
+    log.info("Collecting BPlan")
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    cache_path = path + ".pickle"
+    cached = _load_cache(cache_path, digest)
+
+    with database.DatabaseConnection() as db_c, db_c.new_cursor() as c:
+        c.execute(CREATE_VERSION_TABLE)
+        c.execute("SELECT sha256 FROM bplan_version;")
+        merged = [a for a, in c.fetchall()] == [digest]
+
+        bplan = None
+        if not merged or not cached:
+            bplan = read_bplan(path)
+            cached = bplan["loc"], _network_locations(bplan["nwk"])
+            _save_cache(cache_path, digest, *cached)
+        _remember(*cached)
+
+        if not merged:
+            log.info("Merging BPlan")
+            _merge(c, models.BPlanNetworkLink, NWK_FIELDS, bplan["nwk"])
+            _merge(c, models.BPlanPlatform, PLT_FIELDS, bplan["plt"])
+            _merge(c, models.LocalisedReference, REF_FIELDS, bplan["ref"], _reference_conflict(), "t.source='BPLAN'")
+
+            psycopg2.extras.execute_values(c, """INSERT INTO "{}" (operator, operator_name, url, category) VALUES %s
+                ON CONFLICT (operator) DO UPDATE SET operator_name=EXCLUDED.operator_name;""".format(
+                models.DarwinOperator.__table__.name), [(k, v, None, "B") for k, v in bplan["toc"].items()])
+
+            c.execute("DELETE FROM bplan_version;")
+            c.execute("INSERT INTO bplan_version VALUES (%s, %s);", (digest, datetime.utcnow()))
+        else:
+            log.info("BPlan unchanged since it was last merged")
+
+        # These come from code rather than the file, so they can change whenever it does
+        table = models.LocalisedReference.__table__
+        psycopg2.extras.execute_values(c, 'INSERT INTO "{}" ({}) VALUES %s ON CONFLICT {};'.format(
+            table.name, ", ".join(['"{}"'.format(table.columns[a].name) for a in REF_FIELDS]), _reference_conflict()),
+            list({a[:4]: a for a in LOCALISED_OTHER_REFERENCES}.values()))
+
+        c.execute("COMMIT;")
@@ -1,9 +1,10 @@
-import io, xml.sax, re
+import io, xml.sax, xml.parsers.expat, re, threading
 from collections import OrderedDict
 from typing import Union, Optional, Tuple
 import traceback
 
 from ironswallow.darwin import kb_consts
+from ironswallow.darwin.records import DARWIN_RECORD_TYPES
 
 
 DARWIN_PATHS = ("Pport.uR", "Pport.uR.schedule", "Pport.uR.TS", "Pport.uR.OW",
@@ -17,31 +18,67 @@ DARWIN_NAMED_LIST_PATHS = (
 DARWIN_DETOKENISE = ("Pport.uR.OW.Msg", "Pport.sR.OW.Msg")
 
 
+_POOL = threading.local()
+
+
+def pooled_parser(key, factory) -> "DarwinParser":
+    """The calling thread's parser for key, made by factory the first time and reset after. Pool workers are processes,
+    so each of those ends up with its own too. A parser's result stays valid after it's reused, reset() starts a new
+    root rather than clearing the old one"""
+    try:
+        parsers = _POOL.parsers
+    except AttributeError:
+        parsers = _POOL.parsers = {}
+
+    parser = parsers.get(key)
+    if parser is None:
+        parser = parsers[key] = factory()
+    else:
+        parser.reset()
+    return parser
+
+
 def parse_darwin_suppress(cm_pair) -> Tuple[int, Union[list, str, None]]:
     count, message = cm_pair
-    message_decoded = "-"
     try:
         if message:
-            message_decoded = message.decode("utf8")
-            return count, parse_darwin(message)
+            # Plain dicts and records pickle far more cheaply than OrderedDicts, which matters coming back from a pool
+            return count, parse_darwin(message, dict_type=dict, records=True)
     except Exception as e:
-        return count, message_decoded + "".join(traceback.format_stack())
+        return count, message.decode("utf8", "replace") + "".join(traceback.format_stack())
     return count, None
 
 
-def parse_darwin(message) -> Optional[list]:
+def parse_darwin(message, dict_type=OrderedDict, records=False) -> Optional[list]:
+    """With records, schedules, locations, TS, OW, associations and formations come back as slotted records (see
+    ironswallow.darwin.records) rather than dicts"""
     if message:
-        message_decoded = message.decode("utf8")
-        parsed = DarwinParser(DARWIN_PATHS, DARWIN_DETOKENISE, folded_list=DARWIN_NAMED_LIST_PATHS).parse(io.StringIO(message_decoded))["Pport"]
-        return (parsed.get("uR", {}) or parsed.get("sR", {})).get("list", [])
+        return pport_records(parse_pport(message, dict_type, records))
+
+
+def parse_pport(message, dict_type=OrderedDict, records=False) -> dict:
+    """The whole Pport element, for its attributes (ts, version) as well as the update or snapshot it carries"""
+    parser = pooled_parser(("darwin", dict_type, records), lambda: DarwinParser(
+        DARWIN_PATHS, DARWIN_DETOKENISE, folded_list=DARWIN_NAMED_LIST_PATHS, dict_type=dict_type,
+        record_types=DARWIN_RECORD_TYPES if records else ()))
+    return parser.parse_bytes(message)["Pport"]
+
+
+def pport_records(pport) -> list:
+    return (pport.get("uR", {}) or pport.get("sR", {})).get("list", [])
 
 
 def parse_kb(text) -> dict:
-    return DarwinParser(include_tags=False, folded_list=kb_consts.FOLD_LISTS, exclude_data=kb_consts.EXCLUDE_DATA, collapse_data=kb_consts.FLAT_DATA, collapse_data_types=kb_consts.DATA_TYPES).parse(io.StringIO(text))
+    return pooled_parser("kb", lambda: DarwinParser(include_tags=False, folded_list=kb_consts.FOLD_LISTS, exclude_data=kb_consts.EXCLUDE_DATA, collapse_data=kb_consts.FLAT_DATA, collapse_data_types=kb_consts.DATA_TYPES)).parse(io.StringIO(text))
 
 
 def parse_xml(message) -> dict:
-    return DarwinParser(DARWIN_PATHS, DARWIN_DETOKENISE).parse(io.StringIO(message.decode("utf8")))
+    return pooled_parser("xml", lambda: DarwinParser(DARWIN_PATHS, DARWIN_DETOKENISE)).parse_bytes(message)
+
+
+def parse_xml_chunks(chunks) -> dict:
+    """parse_xml for a document arriving in pieces, none of which need be kept once fed"""
+    return pooled_parser("xml", lambda: DarwinParser(DARWIN_PATHS, DARWIN_DETOKENISE)).parse_chunks(chunks)
 
 
 def _coerce_bool(text) -> bool:
@@ -54,6 +91,25 @@ def _coerce_bool(text) -> bool:
 
 
 
+class _PathNode:
+    """An element path, with everything DarwinParser needs to know about it worked out the first time it's seen"""
+    __slots__ = ("name", "path", "children", "list", "folded", "collapse", "collapse_type", "exclude_data",
+                 "exclude_key", "detokenise", "record_type")
+
+    def __init__(self, parser, name, path):
+        self.name = name
+        self.path = path
+        self.children = {}
+        self.list = path in parser._list_paths
+        self.folded = path in parser._folded_list
+        self.collapse = path in parser._collapse_data
+        self.collapse_type = parser._collapse_types.get(path)
+        self.exclude_data = path in parser._exclude_data
+        self.exclude_key = path in parser._exclude_keys
+        self.detokenise = path in parser._detokenise
+        self.record_type = parser._record_types.get(path)
+
+
 class DarwinParser(xml.sax.ContentHandler):
     _TYPE_REGEXES = [ (re.compile(k),v) for k,v in
         [(r"^[+-]?\d+\.\d+$", float),
@@ -62,12 +118,11 @@ class DarwinParser(xml.sax.ContentHandler):
         (r".*", str)]
     ]
 
-    def __init__(self, list_paths=(), detokenise=(), folded_list=(), exclude_data=(), collapse_data=(), collapse_data_types=(), exclude_keys=(), strip_whitespace=True, include_tags=True, profile=False):
-        self._path = []
-        self._root = OrderedDict()
-        self._dicts = [self._root]
+    def __init__(self, list_paths=(), detokenise=(), folded_list=(), exclude_data=(), collapse_data=(), collapse_data_types=(), exclude_keys=(), strip_whitespace=True, include_tags=True, profile=False, dict_type=OrderedDict, record_types=()):
+        self._dict_type = dict_type
+        self._record_types = dict(record_types)
         # lists are O(n), sets are less
-        self._list_paths = [a.split(".") for a in list_paths]
+        self._list_paths = set(list_paths)
         self._folded_list = set(folded_list)
         self._exclude_data = set(exclude_data)
         self._collapse_data = set(collapse_data)
@@ -78,126 +133,180 @@ class DarwinParser(xml.sax.ContentHandler):
             if type_ == bool:
                 self._collapse_types[key] = _coerce_bool
 
+        self._detokenise = set(detokenise)
+        self._strip_whitespace = strip_whitespace
+        self._include_tags = include_tags
+        self._profile = profile
+        self._reader = None
+
+        # Paths are compiled into a trie as they turn up, so each event is a dict lookup rather than a join. The trie
+        # outlives reset(), so a reused parser only ever works out each path once
+        self._trie = _PathNode(self, None, "")
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the last document, keeping configuration and the compiled path trie, so the parser can be reused"""
+        self._root = self._dict_type()
+        self._dicts = [self._root]
+        # Text for each open dict's "$", joined when it closes
+        self._texts = [None]
+        self._nodes = [self._trie]
+        self._exclude_key_trigger = False
+
         self._collision_paths = []
         self._data_path_status = {}
         self._data_path_count = {}
         self._data_enum = {}
         self._all_paths = set()
-        self._detokenise = detokenise
-        self._strip_whitespace = strip_whitespace
-        self._include_tags = include_tags
-        self._profile = profile
-        self._exclude_key_trigger = False
+
+    def _child(self, node, name) -> _PathNode:
+        child = node.children.get(name)
+        if child is None:
+            child = node.children[name] = _PathNode(self, name, node.path + "." + name if node.path else name)
+        return child
 
     def startElement(self, name, attrs) -> None:
-        name = name.split(":")[-1]
-        current_path = ".".join(self._path)
+        name = name.rpartition(":")[2]
+        node = self._nodes[-1]
 
-        if current_path in self._detokenise:
+        if node.detokenise:
             # rewrite tag back to text
             self.characters("<{}{}{}>".format(name, " "*bool(len(attrs)), " ".join(['{}="{}"'.format(k, v) for k, v in attrs.items()])))
         else:
-            self._path.append(name)
-            new_path = ".".join(self._path)
+            node = self._child(node, name)
+            self._nodes.append(node)
+            parent = self._dicts[-1]
 
-            element_struct = OrderedDict()
+            element_struct = (node.record_type or self._dict_type)()
             if self._include_tags:
                 element_struct["tag"] = name
             element_struct.update([(k, v) for k, v in attrs.items() if not k.startswith("xmlns")])
 
             if self._profile:
                 #TODO: allow excluding attributes, include them here
-                self._all_paths |= {new_path}
+                self._all_paths |= {node.path}
 
             if self._exclude_key_trigger:
                 pass
-            elif new_path in self._exclude_keys:
+            elif node.exclude_key:
                 self._exclude_key_trigger = True
-            elif "list" in self._dicts[-1]:
+            elif "list" in parent:
                 # this is the classic and very silly way of dealing with lists
                 # TODO: convert ironswallow to be less silly
-                self._dicts[-1]["list"].append(element_struct)
-            elif new_path in self._folded_list:
+                parent["list"].append(element_struct)
+            elif node.folded:
                 # This is the much more sensible way
-                if name not in self._dicts[-1]:
-                    self._dicts[-1][name] = []
-                if new_path in self._collapse_data:
-                    self._dicts[-1][name].append("")
+                if name not in parent:
+                    parent[name] = []
+                if node.collapse:
+                    parent[name].append("")
                 else:
-                    self._dicts[-1][name].append(element_struct)
-            elif new_path in self._collapse_data:
-                self._dicts[-1][name] = ""
+                    parent[name].append(element_struct)
+            elif node.collapse:
+                parent[name] = ""
             else:
                 if self._profile:
-                    if name in self._dicts[-1]:
-                        if new_path not in self._collision_paths:
-                            self._collision_paths.append(new_path)
-                self._dicts[-1][name] = element_struct
+                    if name in parent:
+                        if node.path not in self._collision_paths:
+                            self._collision_paths.append(node.path)
+                parent[name] = element_struct
 
-            if new_path not in self._collapse_data and new_path not in self._exclude_keys and not self._exclude_key_trigger:
+            if not node.collapse and not node.exclude_key and not self._exclude_key_trigger:
                 self._dicts.append(element_struct)
+                self._texts.append(None)
 
-            if self._path in self._list_paths:
+            if node.list:
                 element_struct["list"] = []
 
     def endElement(self, name) -> None:
-        name = name.split(":")[-1]
-        current_path = ".".join(self._path)
+        name = name.rpartition(":")[2]
+        node = self._nodes[-1]
 
-        if current_path in self._exclude_keys:
+        if node.exclude_key:
             self._exclude_key_trigger = False
-            self._path.pop()
+            self._nodes.pop()
         elif self._exclude_key_trigger:
-            self._path.pop()
-        elif ".".join(self._path) in self._detokenise and not self._path[-1] == name:
+            self._nodes.pop()
+        elif node.detokenise and not node.name == name:
             self.characters("</{}>".format(name))
-        elif current_path in self._collapse_data:
-            contents = self._dicts[-1][self._path[-1]]
+        elif node.collapse:
+            contents = self._dicts[-1][node.name]
 
-            if current_path in self._collapse_types:
+            if node.collapse_type:
                 # coerce type
-                self._dicts[-1][self._path[-1]] = self._collapse_types[current_path](contents)
+                self._dicts[-1][node.name] = node.collapse_type(contents)
             elif self._profile:
 
                 # slightly silly layout for this because it means you'll need a second pass for typing. sorry.
-                if self._profile and contents and current_path not in self._list_paths and current_path not in self._folded_list:
-                    if not self._data_enum.get(current_path): self._data_enum[current_path] = set()
-                    self._data_enum[current_path] |= {next(iter([v for k, v in self._TYPE_REGEXES if k.match(contents.rstrip())]))}
+                if self._profile and contents and not node.folded:
+                    if not self._data_enum.get(node.path): self._data_enum[node.path] = set()
+                    self._data_enum[node.path] |= {next(iter([v for k, v in self._TYPE_REGEXES if k.match(contents.rstrip())]))}
 
             # Pop path (because that is set) but not dict (because this isn't a dict!!)
-            self._path.pop()
+            self._nodes.pop()
         else:
             if self._profile:
-                self._data_path_count[current_path] = self._data_path_count.get(current_path, False) or list(self._dicts[-1].keys())!=["$"]
+                self._data_path_count[node.path] = self._data_path_count.get(node.path, False) or list(self._dicts[-1].keys())!=["$"]
 
-            self._path.pop()
-            self._dicts.pop()
+            self._nodes.pop()
+            element_struct = self._dicts.pop()
+            text = self._texts.pop()
+            if text:
+                element_struct["$"] = "".join(text)
 
     def characters(self, data) -> None:
-        full_path = ".".join(self._path)
+        node = self._nodes[-1]
 
-        if full_path in self._exclude_data or self._exclude_key_trigger:
+        if node.exclude_data or self._exclude_key_trigger:
             pass
-        elif full_path in self._collapse_data:
+        elif node.collapse:
             # We're writing back directly to our name
-            if full_path in self._folded_list:
-                self._dicts[-1][self._path[-1]][-1] += data
+            if node.folded:
+                self._dicts[-1][node.name][-1] += data
             else:
-                self._dicts[-1][self._path[-1]] += data
+                self._dicts[-1][node.name] += data
         else:
             # it's going in '$' I guess
-            if "$" not in self._dicts[-1]:
+            text = self._texts[-1]
+            if text is None:
                 self._dicts[-1]["$"] = ""
+                text = self._texts[-1] = []
                 if self._profile:
-                    if full_path not in self._data_path_status:
-                        self._data_path_status[full_path] = False
-            if (not data.isspace() and not self._dicts[-1]["$"].isspace()) or not self._strip_whitespace:
-                self._dicts[-1]["$"] += data
+                    if node.path not in self._data_path_status:
+                        self._data_path_status[node.path] = False
+            # Anything kept so far can't be all whitespace, so only the new data needs checking
+            if not data.isspace() or not self._strip_whitespace:
+                text.append(data)
                 if self._profile:
-                    self._data_path_status[full_path] = True
+                    self._data_path_status[node.path] = True
 
     def parse(self, f) -> dict:
-        xml.sax.parse(f, self)
+        if self._reader is None:
+            self._reader = xml.sax.make_parser()
+            self._reader.setContentHandler(self)
+        self._reader.parse(f)
+        return self._finish()
+
+    def parse_bytes(self, data: bytes) -> dict:
+        """Parse an encoded document with expat directly, skipping the decode and SAX's dispatch. Configured as SAX
+        configures expat, so text arrives in the same pieces and the result is the same as parse(). pyexpat parsers
+        can't be rewound once a document's finished, but creating one is cheap next to building a DarwinParser"""
+        return self.parse_chunks((data,))
+
+    def parse_chunks(self, chunks) -> dict:
+        """parse_bytes, feeding expat each chunk of the encoded document as it comes. Text split across chunks
+        arrives in more pieces, so as with parse(), chunks want to be big enough that whitespace is rarely cut off
+        on its own"""
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        for chunk in chunks:
+            parser.Parse(chunk, False)
+        parser.Parse(b"", True)
+        return self._finish()
+
+    def _finish(self) -> dict:
         if self._profile:
             self._data_path_status = [k for k, v in self._data_path_status.items() if not v]
             self._data_path_count = [k for k, v in self._data_path_count.items() if not v]
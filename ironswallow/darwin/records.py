@@ -0,0 +1,132 @@
+from collections.abc import Mapping
+from operator import attrgetter
+
+
+def _rebuild(cls, values, extra) -> "Record":
+    record = cls.__new__(cls)
+    for slot, value in zip(cls.__slots__, values):
+        setattr(record, slot, value)
+    record._extra = extra
+    return record
+
+
+class Record(Mapping):
+    """Slotted stand-in for the dicts DarwinParser builds, read through the same keys ("$" is stored as text). Parsed
+    values are never None, so None marks a missing key. Anything Darwin sends which isn't a declared field ends up in a
+    small overflow dict, rather than being an error."""
+    __slots__ = ("_extra",)
+    _KEYS = {}
+    _VALUES = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._KEYS = {("$" if a == "text" else a): a for a in cls.__slots__}
+        cls._VALUES = attrgetter(*cls.__slots__)
+
+    def __init__(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self._extra = None
+
+    def __getitem__(self, key):
+        slot = self._KEYS.get(key)
+        value = getattr(self, slot) if slot else (self._extra or {}).get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        slot = self._KEYS.get(key)
+        if slot:
+            setattr(self, slot, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def get(self, key, default=None):
+        slot = self._KEYS.get(key)
+        value = getattr(self, slot) if slot else (self._extra or {}).get(key)
+        return default if value is None else value
+
+    def __contains__(self, key) -> bool:
+        slot = self._KEYS.get(key)
+        return (getattr(self, slot) if slot else (self._extra or {}).get(key)) is not None
+
+    def __iter__(self):
+        for key, slot in self._KEYS.items():
+            if getattr(self, slot) is not None:
+                yield key
+        yield from self._extra or ()
+
+    def __len__(self) -> int:
+        return sum([1 for _ in self])
+
+    def update(self, pairs) -> None:
+        for key, value in pairs:
+            self[key] = value
+
+    def __repr__(self) -> str:
+        return "{}({})".format(type(self).__name__, dict(self.items()))
+
+    def __reduce__(self):
+        # A flat tuple of values pickles much more compactly than the slot dict pickle would use by default
+        return _rebuild, (type(self), self._VALUES(self), self._extra)
+
+
+class Schedule(Record):
+    __slots__ = ("tag", "rid", "uid", "trainId", "rsid", "ssd", "toc", "status", "trainCat", "isPassengerSvc",
+                 "isActive", "deleted", "isCharter", "qtrain", "can", "list", "text")
+
+
+class ScheduleLocation(Record):
+    __slots__ = ("tag", "tpl", "act", "planAct", "can", "plat", "pta", "ptd", "wta", "wtd", "wtp", "rdelay", "fd",
+                 "affectedByDiversion", "text")
+
+
+class Reason(Record):
+    __slots__ = ("tag", "tiploc", "near", "text")
+
+
+class TS(Record):
+    __slots__ = ("tag", "rid", "uid", "ssd", "isReverseFormation", "list", "text")
+
+
+class TSLocation(Record):
+    __slots__ = ("tag", "tpl", "pta", "ptd", "wta", "wtd", "wtp", "arr", "pass", "dep", "plat", "suppr", "length",
+                 "detachFront", "lateReason", "uncertainty", "affectedBy", "text")
+
+
+class OW(Record):
+    __slots__ = ("tag", "id", "cat", "sev", "suppress", "list", "text")
+
+
+class Association(Record):
+    __slots__ = ("tag", "tiploc", "category", "isCancelled", "isDeleted", "main", "assoc", "text")
+
+
+class ScheduleFormations(Record):
+    __slots__ = ("tag", "rid", "formation", "text")
+
+
+class Formation(Record):
+    __slots__ = ("tag", "fid", "src", "srcInst", "coaches", "text")
+
+
+SCHEDULE_LOCATION_TAGS = ("OR", "OPOR", "IP", "OPIP", "PP", "DT", "OPDT")
+
+# DarwinParser record_types for push port messages, keyed by path
+DARWIN_RECORD_TYPES = {}
+for _prefix in ("Pport.uR", "Pport.sR"):
+    DARWIN_RECORD_TYPES.update({
+        _prefix + ".schedule": Schedule,
+        _prefix + ".schedule.cancelReason": Reason,
+        _prefix + ".TS": TS,
+        _prefix + ".TS.Location": TSLocation,
+        _prefix + ".TS.LateReason": Reason,
+        _prefix + ".OW": OW,
+        _prefix + ".association": Association,
+        _prefix + ".scheduleFormations": ScheduleFormations,
+        _prefix + ".scheduleFormations.formation": Formation,
+    })
+    DARWIN_RECORD_TYPES.update({_prefix + ".schedule." + a: ScheduleLocation for a in SCHEDULE_LOCATION_TAGS})
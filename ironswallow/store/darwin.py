@@ -1,20 +1,24 @@
 import datetime, json, re, logging, time, threading
 from collections import OrderedDict
-from decimal import Decimal
+from concurrent.futures import Future
 from queue import Queue
-from queue import LifoQueue
-from typing import Union
+from typing import Union, Optional, Tuple
 
 import psycopg2.extras
 
 from ironswallow.store import meta
-from ironswallow.util import query
+from ironswallow.util import query, metrics
+from ironswallow.util.pgcopy import copy_buffer
+from ironswallow.util.times import process_time, process_date, working_time_part, day_rollover
 from main import LOCATIONS, REASONS
 
 OBSERVED_LOCATIONS = set()
 
 log = logging.getLogger("IronSwallow")
 
+metrics.describe("ironswallow_queue_wait_seconds", "Time statements spent queued before execution, by record tag")
+metrics.describe("ironswallow_execute_seconds", "Time spent executing statements, by record tag")
+
 COACH_CLASS_SHORT = {
     "First": "1",
     "Standard": "2",
@@ -27,33 +31,12 @@ TOILET_TYPE_SHORT = {
     "Standard": "L",
 }
 
-def compare_time(t1, t2) -> int:
-    if not (t1 and t2):
-        return 0
-    t1, t2 = [a.hour*3600+a.minute*60+a.second for a in (t1,t2)]
-    return (Decimal(t1)-Decimal(t2))/3600
-
-
-def process_time(time) -> datetime.time:
-    if not time:
-        return None
-    if len(time) == 5:
-        time += ":00"
-    return datetime.datetime.strptime(time, "%H:%M:%S").time()
-
-
 def full_original_wt(location):
     return form_original_wt([process_time(location.get(a)) for a in ("wta", "wtp", "wtd")])
 
 
 def form_original_wt(times) -> str:
-    out = ""
-    for time in times:
-        if time:
-            out += time.strftime("%H%M%S")
-        else:
-            out += "      "
-    return out
+    return "".join([working_time_part(a) for a in times])
 
 
 def process_reason(reason):
@@ -65,54 +48,300 @@ def process_reason(reason):
         ])
 
 
-class MessageProcessor:
-    """In theory you can use this without the context manager, but don't"""
+def schedule_fingerprint(schedule_row, cancel_reason, locations) -> Tuple[int, dict]:
+    """Hash of the schedule itself, and of each calling point keyed by (tiploc, original_wt)"""
+    *columns, origins, destinations = schedule_row
+    location_hashes = {}
+    for location in locations:
+        location_hashes.setdefault((location[3], location[5]), hash(location))
+    return hash((*columns, tuple(origins), tuple(destinations), cancel_reason)), location_hashes
+
+
+class SnapshotLoader:
+    """Stages schedules and associations for COPY into temporary tables, which are then merged into the darwin_*
+    tables with a handful of set-based statements. Only meant for use straight after the tables are truncated, within
+    the same transaction - the staging tables are dropped on commit."""
+
+    def __init__(self, mp, flush_size=10000):
+        self.mp = mp
+        self.flush_size = flush_size
+        self._schedules = OrderedDict()
+        self._associations = []
+
+    def begin(self) -> None:
+        self.mp.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS staging_schedules (
+            uid VARCHAR(7), rid CHAR(15), rsid CHAR(8), ssd DATE, signalling_id CHAR(4), status CHAR(1), category CHAR(2),
+            operator CHAR(2), is_active BOOL, is_charter BOOL, is_deleted BOOL, is_passenger BOOL,
+            origins JSON, destinations JSON, cancel_reason JSON) ON COMMIT DROP;""")
+        self.mp.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS staging_schedule_locations
+            (LIKE darwin_schedule_locations INCLUDING DEFAULTS) ON COMMIT DROP;""")
+        self.mp.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS staging_associations
+            (LIKE darwin_associations INCLUDING DEFAULTS) ON COMMIT DROP;""")
+
+    def is_pending(self, rid) -> bool:
+        return rid in self._schedules
+
+    def stage_schedule(self, rid, schedule_row, cancel_reason, locations) -> None:
+        # Pushport files may resend a schedule which is still staged, the later one wins
+        self._schedules.pop(rid, None)
+        self._schedules[rid] = (schedule_row, cancel_reason, locations)
+        if len(self._schedules) >= self.flush_size:
+            self.flush()
+
+    def stage_associations(self, rows) -> None:
+        self._associations.extend([a[:6] for a in rows])
+
+    def flush(self) -> None:
+        if not (self._schedules or self._associations):
+            return
 
+        tag, self.mp._metric_tag = self.mp._metric_tag, "snapshot"
+        schedule_rows, location_rows = [], []
+        for schedule_row, cancel_reason, locations in self._schedules.values():
+            *columns, origins, destinations = schedule_row
+            schedule_rows.append((*columns, "[{}]".format(",".join(origins)), "[{}]".format(",".join(destinations)), cancel_reason))
+            location_rows.extend(locations)
+
+        execute = self.mp.execute
+        execute("TRUNCATE staging_schedules, staging_schedule_locations, staging_associations;")
+        execute("COPY staging_schedules FROM STDIN;", copy_buffer(schedule_rows), copy=True)
+        execute("""COPY staging_schedule_locations (rid, index, type, tiploc, activity, original_wt, pta, wta, wtp, ptd, wtd,
+            cancelled, rdelay) FROM STDIN;""", copy_buffer(location_rows), copy=True)
+        execute("""COPY staging_associations (category, tiploc, main_rid, main_original_wt, assoc_rid, assoc_original_wt)
+            FROM STDIN;""", copy_buffer(self._associations), copy=True)
+
+        # Schedules staged in an earlier flush may be replaced, so hang on to any of their associations. Straight after
+        # the truncate this finds nothing
+        execute("""INSERT INTO staging_associations (category, tiploc, main_rid, main_original_wt, assoc_rid, assoc_original_wt)
+            SELECT a.category,a.tiploc,a.main_rid,a.main_original_wt,a.assoc_rid,a.assoc_original_wt
+            FROM darwin_associations AS a WHERE a.main_rid IN (SELECT rid FROM staging_schedules)
+            OR a.assoc_rid IN (SELECT rid FROM staging_schedules);""")
+        execute("DELETE FROM darwin_schedule_locations WHERE rid IN (SELECT rid FROM staging_schedules);")
+
+        execute("""INSERT INTO darwin_schedules (uid, rid, rsid, ssd, signalling_id, status, category, operator, is_active,
+            is_charter, is_deleted, is_passenger, origins, destinations, cancel_reason)
+            SELECT uid, rid, rsid, ssd, signalling_id, status, category, operator, is_active, is_charter, is_deleted,
+            is_passenger, ARRAY(SELECT json_array_elements(origins)), ARRAY(SELECT json_array_elements(destinations)),
+            cancel_reason FROM staging_schedules
+            ON CONFLICT (rid) DO UPDATE SET
+            signalling_id=EXCLUDED.signalling_id, status=EXCLUDED.status, category=EXCLUDED.category,
+            operator=EXCLUDED.operator, is_active=EXCLUDED.is_active, is_charter=EXCLUDED.is_charter,
+            is_deleted=EXCLUDED.is_deleted, is_passenger=EXCLUDED.is_passenger, origins=EXCLUDED.origins,
+            destinations=EXCLUDED.destinations, cancel_reason=COALESCE(EXCLUDED.cancel_reason, darwin_schedules.cancel_reason);""")
+        execute("INSERT INTO darwin_schedule_locations SELECT * FROM staging_schedule_locations ON CONFLICT DO NOTHING;")
+        execute("""INSERT INTO darwin_associations (category, tiploc, main_rid, main_original_wt, assoc_rid, assoc_original_wt)
+            SELECT a.category,a.tiploc,a.main_rid,a.main_original_wt,a.assoc_rid,a.assoc_original_wt FROM staging_associations AS a WHERE
+            EXISTS (SELECT * FROM darwin_schedule_locations AS l WHERE l.tiploc=a.tiploc AND l.rid=a.main_rid AND l.original_wt=a.main_original_wt) AND
+            EXISTS (SELECT * FROM darwin_schedule_locations AS l WHERE l.tiploc=a.tiploc AND l.rid=a.assoc_rid AND l.original_wt=a.assoc_original_wt)
+            ON CONFLICT(tiploc,main_rid,assoc_rid) DO NOTHING;""")
+
+        self._schedules.clear()
+        self._associations.clear()
+        self.mp._metric_tag = tag
+
+
+class _Shard:
     def __init__(self, cursor):
         self.cursor = cursor
-        self._query_queue = Queue(maxsize=1000)
-        self._query_fetch = LifoQueue()
-        self._thread_quit = False
+        self.queue = Queue(maxsize=1000)
+        self.thread = None
+        self.quit = False
+
+
+class _Synchronised:
+    """Queued on every shard. Each shard executes the statement, then the first shard runs the deferred statements
+    while the others wait for it"""
+    def __init__(self, query, params, shard_count, run_deferred=False):
+        self.query = query
+        self.params = params
+        self.barrier = threading.Barrier(shard_count)
+        self.run_deferred = run_deferred
+        self.queued = time.perf_counter()
+
+
+class MessageProcessor:
+    """In theory you can use this without the context manager, but don't
+
+    Given more than one cursor, statements are spread across them by rid, so statements for the same service stay in
+    order. Anything without a rid goes to the first. Associations span two services, which may belong to separate
+    connections and can't see each other's uncommitted locations, so their inserts are deferred until every shard
+    has committed."""
+
+    def __init__(self, cursor, *pool_cursors, schedule_cache_size=0):
+        self._shards = [_Shard(a) for a in (cursor, *pool_cursors)]
+        self._deferred = []
+        self._deferred_lock = threading.Lock()
         self._thread_start = False
-        self._thread = None
+        self._snapshot = None
+        # rid -> schedule_fingerprint of what was last written, least recently used first
+        self._schedule_cache = OrderedDict()
+        self._schedule_cache_size = schedule_cache_size
+        # Record tag whose statements are being queued, for metrics
+        self._metric_tag = None
+        # rids needing their origins/destinations renewed, handed to meta once committed
+        self._dirty_rids = set()
+
+    @property
+    def cursor(self):
+        return self._shards[0].cursor
 
     def count(self) -> int:
-        return self._query_queue.qsize()
-
-    def execute(self, query: str, params: Union[tuple, list]=(), batch=False, retain=False, use_retain=False):
-        self._query_queue.put((query, params, batch, retain, use_retain))
+        return sum([a.queue.qsize() for a in self._shards])
+
+    def _is_sharded(self) -> bool:
+        return len(self._shards) > 1 and self._thread_start and self._snapshot is None
+
+    def _shard_for(self, rid) -> _Shard:
+        if rid is None or not self._is_sharded():
+            return self._shards[0]
+        return self._shards[hash(rid) % len(self._shards)]
+
+    def execute(self, query: str, params: Union[tuple, list, Future]=(), batch=False, retain=False, copy=False,
+                rid=None, defer=False, broadcast=False) -> Optional[Future]:
+        """Queue a statement. With retain, returns a Future for the rows it fetches, which can be passed back in as the
+        params of a later statement."""
+        if broadcast and self._is_sharded():
+            entry = _Synchronised(query, params, len(self._shards))
+            for shard in self._shards:
+                shard.queue.put(entry)
+            return None
+
+        result = Future() if retain else None
+        self._shard_for(rid).queue.put((query, params, batch, result, copy, defer and self._is_sharded(),
+                                        self._metric_tag, time.perf_counter()))
+        return result
+
+    def commit(self) -> None:
+        if self._is_sharded():
+            entry = _Synchronised("COMMIT;", (), len(self._shards), run_deferred=True)
+            for shard in self._shards:
+                shard.queue.put(entry)
+        else:
+            self.execute("COMMIT;")
+
+        if self._dirty_rids:
+            # Marked only after the commit, so meta never picks a rid up before it can see what changed
+            self.call(meta.mark_dirty, self._dirty_rids)
+            self._dirty_rids = set()
+
+    def sync(self) -> None:
+        """Wait for every shard to reach this point before any of them carry on"""
+        if self._is_sharded():
+            entry = _Synchronised(None, (), len(self._shards))
+            for shard in self._shards:
+                shard.queue.put(entry)
+
+    def call(self, func, *args) -> None:
+        """Run func on the executor thread, once everything queued before it has been executed"""
+        self.execute(func, args)
+
+    def _cached_schedule(self, rid) -> Optional[Tuple[int, dict]]:
+        fingerprint = self._schedule_cache.get(rid)
+        if fingerprint:
+            self._schedule_cache.move_to_end(rid)
+        return fingerprint
+
+    def _cache_schedule(self, rid, fingerprint) -> None:
+        if self._schedule_cache_size:
+            self._schedule_cache[rid] = fingerprint
+            self._schedule_cache.move_to_end(rid)
+            while len(self._schedule_cache) > self._schedule_cache_size:
+                self._schedule_cache.popitem(last=False)
+
+    def begin_snapshot(self, flush_size=10000) -> None:
+        """Switch schedules and associations over to bulk loading, see SnapshotLoader"""
+        self.sync()
+        self._schedule_cache.clear()
+        self._snapshot = SnapshotLoader(self, flush_size)
+        self._snapshot.begin()
+
+    def end_snapshot(self) -> None:
+        self._snapshot.flush()
+        self._snapshot = None
+
+    def _sync_snapshot(self, rid) -> None:
+        # Anything updating darwin_schedules has to wait until the schedule it refers to has been merged
+        if self._snapshot is not None and self._snapshot.is_pending(rid):
+            self._snapshot.flush()
 
     def __enter__(self) -> "MessageProcessor":
-        self.thread = threading.Thread(target=self._execute_thread)
-        self.thread.start()
+        for shard in self._shards:
+            shard.thread = threading.Thread(target=self._execute_thread, args=(shard,))
+            shard.thread.start()
         self._thread_start = True
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._query_queue.put(None)
-        while not self._thread_quit:
+        for shard in self._shards:
+            shard.queue.put(None)
+        while not all([a.quit for a in self._shards]):
             time.sleep(0.1)
 
         return False
 
-    def _execute_thread(self):
+    @staticmethod
+    def _run(cursor, query, params, batch, copy) -> None:
+        if callable(query):
+            query(*params)
+        elif copy:
+            cursor.copy_expert(query, params)
+        elif batch:
+            psycopg2.extras.execute_batch(cursor, query, params)
+        else:
+            cursor.execute(query, params)
+
+    def _run_deferred(self, cursor) -> None:
+        with self._deferred_lock:
+            deferred, self._deferred = self._deferred, []
+
+        if deferred:
+            for query, params, batch in deferred:
+                self._run(cursor, query, params, batch, False)
+            cursor.execute("COMMIT;")
+
+    def _execute_thread(self, shard=None):
+        shard = shard or self._shards[0]
         while True:
-            entry = self._query_queue.get()
+            entry = shard.queue.get()
             if not entry:
-                self._thread_quit = True
+                shard.quit = True
                 return
-            query, params, batch, retain, use_retain = entry
-
-            if use_retain:
-                params = self._query_fetch.get()
 
-            if batch:
-                psycopg2.extras.execute_batch(self.cursor, query, params)
-            else:
-                self.cursor.execute(query, params)
-
-            if retain:
-                self._query_fetch.put(self.cursor.fetchall())
+            started = time.perf_counter()
+
+            if isinstance(entry, _Synchronised):
+                tag = "commit" if entry.run_deferred else "sync"
+                metrics.observe("ironswallow_queue_wait_seconds", started-entry.queued, tag=tag)
+                if entry.query:
+                    shard.cursor.execute(entry.query, entry.params)
+                entry.barrier.wait()
+                if entry.run_deferred and shard is self._shards[0]:
+                    self._run_deferred(shard.cursor)
+                entry.barrier.wait()
+                metrics.observe("ironswallow_execute_seconds", time.perf_counter()-started, tag=tag)
+                continue
+
+            query, params, batch, result, copy, defer, tag, queued = entry
+            tag = tag or ("call" if callable(query) else "other")
+            metrics.observe("ironswallow_queue_wait_seconds", started-queued, tag=tag)
+
+            if isinstance(params, Future):
+                params = params.result()
+
+            if defer:
+                with self._deferred_lock:
+                    self._deferred.append((query, params, batch))
+                continue
+
+            try:
+                self._run(shard.cursor, query, params, batch, copy)
+                if result is not None:
+                    result.set_result(shard.cursor.fetchall())
+            except Exception as e:
+                if result is not None:
+                    result.set_exception(e)
+                raise
+            metrics.observe("ironswallow_execute_seconds", time.perf_counter()-started, tag=tag)
 
     def store(self, parsed) -> None:
         global OBSERVED_LOCATIONS
@@ -122,54 +351,34 @@ class MessageProcessor:
         assoc_batch = []
 
         for record in parsed:
+            self._metric_tag = record["tag"]
             if record["tag"] == "schedule":
 
                 index = 0
                 last_time, ssd_offset = None, 0
-
-                # I feel like I owe an explanation for this abomination, so here we go - it turns out that breaking a
-                # foreign key reference by means other than straightforward deletion isn't something that you can handle
-                # with constraints in psql. Ideally you could very neatly put aside something that didn't match back
-                # up, but that's just not how it goes
-                # The select here is so bizarre just so this can be fed direct back into the insert later on
-                self.execute("SELECT category,tiploc,main_rid,main_original_wt,assoc_rid,assoc_original_wt, "
-                          "tiploc,main_rid,main_original_wt,"
-                          "tiploc,assoc_rid,assoc_original_wt "
-                          "FROM darwin_associations WHERE main_rid=%s OR assoc_rid=%s", (record["rid"], record["rid"]), retain=True)
-
-                self.execute("DELETE FROM darwin_schedule_locations WHERE rid=%s;", (record["rid"],))
+                ssd = process_date(record["ssd"])
 
                 origins, destinations = [], []
                 batch = []
+                cancel_reason = None
 
                 for location in record["list"]:
                     if location["tag"] in ["OPOR", "OR", "OPIP", "IP", "PP", "DT", "OPDT"]:
                         OBSERVED_LOCATIONS |= {location["tpl"]}
 
-                        times = []
-                        for time_n, time in [(a, location.get(a, None)) for a in ["pta", "wta", "wtp", "ptd", "wtd"]]:
+                        local_times = [process_time(location.get(a)) for a in ["pta", "wta", "wtp", "ptd", "wtd"]]
+                        stamps = []
+                        for time in local_times:
                             if time:
-                                if len(time)==5:
-                                    time += ":00"
-                                time = datetime.datetime.strptime(time, "%H:%M:%S").time()
-
-                                # Crossed midnight, increment ssd offset
-                                if compare_time(time, last_time) < -6:
-                                    ssd_offset += 1
-                                # Normal increase or decrease, nothing we really need to do here
-                                elif -6 <= compare_time(time, last_time) <= +18:
-                                    pass
-                                # Back in time, crossed midnight (in reverse), decrement ssd offset
-                                elif +18 < compare_time(time, last_time):
-                                    ssd_offset -= 1
-
+                                # Crossed midnight (either way round), shift the ssd offset
+                                ssd_offset += day_rollover(time, last_time)
                                 last_time = time
-                                time = datetime.datetime.combine(datetime.datetime.strptime(record["ssd"], "%Y-%m-%d").date(), time) + datetime.timedelta(days=ssd_offset)
-                            times.append(time)
+                                time = datetime.datetime.combine(ssd, time) + datetime.timedelta(days=ssd_offset)
+                            stamps.append(time)
 
-                        original_wt = form_original_wt([process_time(location.get(a)) for a in ("wta", "wtp", "wtd")])
+                        original_wt = form_original_wt(local_times[1:3] + local_times[4:])
 
-                        batch.append((record["rid"], index, location["tag"], location["tpl"], location.get("act", ''), original_wt, *times, bool(location.get("can")), location.get("rdelay", 0)))
+                        batch.append((record["rid"], index, location["tag"], location["tpl"], location.get("act", ''), original_wt, *stamps, bool(location.get("can")), location.get("rdelay", 0)))
 
                         loc_dict = OrderedDict([("source", "SC"), ("type", location["tag"]), ("activity", location.get("act",'')), ("cancelled", bool(location.get("can")))])
                         loc_dict.update(LOCATIONS[location["tpl"]])
@@ -182,25 +391,76 @@ class MessageProcessor:
                         index += 1
 
                     elif location["tag"]=="cancelReason":
-                        self.execute("UPDATE darwin_schedules SET cancel_reason=%s WHERE rid=%s;", (json.dumps(process_reason(location)), record["rid"]))
+                        cancel_reason = json.dumps(process_reason(location))
 
-                self.execute("""INSERT INTO darwin_schedules VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s::json[], %s::json[])
-                    ON CONFLICT (rid) DO UPDATE SET
-                    signalling_id=EXCLUDED.signalling_id, status=EXCLUDED.status, category=EXCLUDED.category,
-                    operator=EXCLUDED.operator, is_active=EXCLUDED.is_active, is_charter=EXCLUDED.is_charter,
-                    is_deleted=EXCLUDED.is_deleted, is_passenger=EXCLUDED.is_passenger, origins=EXCLUDED.origins, destinations=EXCLUDED.destinations;""", (
+                schedule_row = (
                     record["uid"], record["rid"], record.get("rsid"), record["ssd"], record["trainId"],
                     record.get("status") or "P", record.get("trainCat") or "OO", record["toc"], record.get("isActive") or True,
                     bool(record.get("isCharter")), bool(record.get("deleted")), record.get("isPassengerSvc") or True,
                     origins, destinations
-                    ))
-
-                self.execute("""INSERT INTO darwin_schedule_locations VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING;""", params=batch, batch=True)
-
-                self.execute("""INSERT INTO darwin_associations
-                (category,tiploc,main_rid,main_original_wt,assoc_rid,assoc_original_wt) SELECT %s,%s,%s,%s,%s,%s WHERE
-                EXISTS (SELECT * FROM darwin_schedule_locations WHERE tiploc=%s AND rid=%s AND original_wt=%s) AND
-                EXISTS (SELECT * FROM darwin_schedule_locations WHERE tiploc=%s AND rid=%s AND original_wt=%s) ON CONFLICT DO NOTHING;""", batch=True, use_retain=True)
+                    )
+
+                fingerprint = schedule_fingerprint(schedule_row, cancel_reason, batch)
+
+                if self._snapshot is not None:
+                    self._snapshot.stage_schedule(record["rid"], schedule_row, cancel_reason, batch)
+                    self._cache_schedule(record["rid"], fingerprint)
+                    self._dirty_rids.add(record["rid"])
+                    continue
+
+                # Darwin resends identical schedules constantly, compare with what we last wrote, if anything
+                cached = self._cached_schedule(record["rid"])
+                if cached == fingerprint:
+                    continue
+                elif cached:
+                    changed = {k for k, v in fingerprint[1].items() if cached[1].get(k) != v}
+                    deleted = [(record["rid"], *k) for k in cached[1] if k in changed or k not in fingerprint[1]]
+                    batch = [a for a in batch if (a[3], a[5]) in changed]
+                else:
+                    deleted = None
+
+                if deleted is None or deleted:
+                    # I feel like I owe an explanation for this abomination, so here we go - it turns out that breaking a
+                    # foreign key reference by means other than straightforward deletion isn't something that you can handle
+                    # with constraints in psql. Ideally you could very neatly put aside something that didn't match back
+                    # up, but that's just not how it goes
+                    # The select here is so bizarre just so this can be fed direct back into the insert later on
+                    associations = self.execute("SELECT category,tiploc,main_rid,main_original_wt,assoc_rid,assoc_original_wt, "
+                              "tiploc,main_rid,main_original_wt,"
+                              "tiploc,assoc_rid,assoc_original_wt "
+                              "FROM darwin_associations WHERE main_rid=%s OR assoc_rid=%s", (record["rid"], record["rid"]), retain=True, rid=record["rid"])
+
+                if deleted is None:
+                    self.execute("DELETE FROM darwin_schedule_locations WHERE rid=%s;", (record["rid"],), rid=record["rid"])
+                elif deleted:
+                    self.execute("DELETE FROM darwin_schedule_locations WHERE rid=%s AND tiploc=%s AND original_wt=%s;",
+                                 deleted, batch=True, rid=record["rid"])
+
+                if not cached or cached[0] != fingerprint[0]:
+                    # This overwrites origins and destinations with ones lacking associations. The cancel reason goes in
+                    # with the row, an UPDATE ahead of it would miss a schedule that isn't there yet, and a resend
+                    # wouldn't get another go at it
+                    self._dirty_rids.add(record["rid"])
+                    self.execute("""INSERT INTO darwin_schedules (uid, rid, rsid, ssd, signalling_id, status, category,
+                        operator, is_active, is_charter, is_deleted, is_passenger, origins, destinations, cancel_reason)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s::json[], %s::json[], %s)
+                        ON CONFLICT (rid) DO UPDATE SET
+                        signalling_id=EXCLUDED.signalling_id, status=EXCLUDED.status, category=EXCLUDED.category,
+                        operator=EXCLUDED.operator, is_active=EXCLUDED.is_active, is_charter=EXCLUDED.is_charter,
+                        is_deleted=EXCLUDED.is_deleted, is_passenger=EXCLUDED.is_passenger, origins=EXCLUDED.origins, destinations=EXCLUDED.destinations,
+                        cancel_reason=COALESCE(EXCLUDED.cancel_reason, darwin_schedules.cancel_reason);""",
+                        (*schedule_row, cancel_reason), rid=record["rid"])
+
+                if batch:
+                    self.execute("""INSERT INTO darwin_schedule_locations VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING;""", params=batch, batch=True, rid=record["rid"])
+
+                if deleted is None or deleted:
+                    self.execute("""INSERT INTO darwin_associations
+                    (category,tiploc,main_rid,main_original_wt,assoc_rid,assoc_original_wt) SELECT %s,%s,%s,%s,%s,%s WHERE
+                    EXISTS (SELECT * FROM darwin_schedule_locations WHERE tiploc=%s AND rid=%s AND original_wt=%s) AND
+                    EXISTS (SELECT * FROM darwin_schedule_locations WHERE tiploc=%s AND rid=%s AND original_wt=%s) ON CONFLICT DO NOTHING;""", associations, batch=True, rid=record["rid"], defer=True)
+
+                self._cache_schedule(record["rid"], fingerprint)
 
             if record["tag"] == "TS":
                 batch = []
@@ -230,16 +490,20 @@ class MessageProcessor:
                         location.get("length", {}).get("$")))
 
                     if location["tag"]=="LateReason":
-                        self.execute("UPDATE darwin_schedules SET delay_reason=%s WHERE rid=%s;", (json.dumps(process_reason(location)), record["rid"]))
+                        self._sync_snapshot(record["rid"])
+                        self.execute("UPDATE darwin_schedules SET delay_reason=%s WHERE rid=%s;", (json.dumps(process_reason(location)), record["rid"]), rid=record["rid"])
 
                 self.execute("""INSERT INTO darwin_schedule_status VALUES (%s,%s,%s,  %s,%s,%s,  %s,%s,%s, %s,%s,%s, %s,%s,%s, %s,%s,%s,%s,%s, %s)
                     ON CONFLICT (rid, tiploc, original_wt) DO UPDATE SET
                     (ta,tp,td, ta_source,tp_source,td_source, ta_type,tp_type,td_type, ta_delayed,tp_delayed,td_delayed, length, plat,plat_suppressed,plat_cis_suppressed,plat_confirmed,plat_source)=
                     (EXCLUDED.ta,EXCLUDED.tp,EXCLUDED.td, EXCLUDED.ta_source,EXCLUDED.tp_source,EXCLUDED.td_source, EXCLUDED.ta_type,EXCLUDED.tp_type,EXCLUDED.td_type, EXCLUDED.ta_delayed,EXCLUDED.tp_delayed,EXCLUDED.td_delayed, EXCLUDED.length, EXCLUDED.plat,EXCLUDED.plat_suppressed,EXCLUDED.plat_cis_suppressed,EXCLUDED.plat_confirmed,EXCLUDED.plat_source);""",
-                    params=batch, batch=True)
+                    params=batch, batch=True, rid=record["rid"])
 
             if record["tag"]=="deactivated":
-                self.execute("UPDATE darwin_schedules SET is_active=FALSE WHERE rid=%s;", (record["rid"],))
+                self._sync_snapshot(record["rid"])
+                # This changes the schedule behind the cache's back, so the next copy has to be written in full
+                self._schedule_cache.pop(record["rid"], None)
+                self.execute("UPDATE darwin_schedules SET is_active=FALSE WHERE rid=%s;", (record["rid"],), rid=record["rid"])
             if record["tag"]=="OW":
                 station_list = [a["crs"] for a in record["list"] if a["tag"] == "Station"]
 
@@ -262,6 +526,7 @@ class MessageProcessor:
             if record["tag"] == "association":
                 main_owt = full_original_wt(record["main"])
                 assoc_owt = full_original_wt(record["assoc"])
+                self._dirty_rids.update((record["main"]["rid"], record["assoc"]["rid"]))
 
                 if record["category"]=="JJ":
                     # Semantically it makes a lot more sense to invert joins, so that all associations point to the "next" service
@@ -275,7 +540,8 @@ class MessageProcessor:
                                         record["tiploc"], record["main"]["rid"], main_owt,
                                         record["tiploc"], record["assoc"]["rid"], assoc_owt))
             if record["tag"] == "scheduleFormations":
-                self.execute("DELETE FROM darwin_formations WHERE rid=%s;", (record["rid"],))
+                self._sync_snapshot(record["rid"])
+                self.execute("DELETE FROM darwin_formations WHERE rid=%s;", (record["rid"],), rid=record["rid"])
                 formation_summaries = []
                 coach_batch = []
                 seq = 0
@@ -305,15 +571,19 @@ class MessageProcessor:
                     formation_summaries.append("=".join(["-".join(a) for a in unit_coaches.values()]))
 
                 self.execute("INSERT INTO darwin_formations VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING;",
-                             coach_batch, batch=True)
+                             coach_batch, batch=True, rid=record["rid"])
                 self.execute("UPDATE darwin_schedules SET formation_summary=%s WHERE rid=%s;",
-                             (" / ".join(formation_summaries), record["rid"]))
-        if assoc_batch:
+                             (" / ".join(formation_summaries), record["rid"]), rid=record["rid"])
+        self._metric_tag = "association"
+        if assoc_batch and self._snapshot is not None:
+            self._snapshot.stage_associations(assoc_batch)
+        elif assoc_batch:
             self.execute("""INSERT INTO darwin_associations SELECT %s, %s, %s, %s, %s, %s WHERE
                                 EXISTS (SELECT * FROM darwin_schedule_locations WHERE tiploc=%s AND rid=%s AND original_wt=%s) AND
                                 EXISTS (SELECT * FROM darwin_schedule_locations WHERE tiploc=%s AND rid=%s AND original_wt=%s)
-                                ON CONFLICT(tiploc,main_rid,assoc_rid) DO NOTHING;""", assoc_batch, batch=True)
+                                ON CONFLICT(tiploc,main_rid,assoc_rid) DO NOTHING;""", assoc_batch, batch=True, defer=True)
+        self._metric_tag = None
 
         if not self._thread_start:
-            self._query_queue.put(None)
+            self._shards[0].queue.put(None)
             self._execute_thread()
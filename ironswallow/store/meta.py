@@ -1,20 +1,183 @@
-import json, logging
+import json, logging, threading
 from collections import OrderedDict
+from typing import List
 
 import psycopg2.extras
 
-from ironswallow.util import query
+from ironswallow.util import query, config
 from main import LOCATIONS
 
 log = logging.getLogger("IronSwallow")
 
-def renew_schedule_association_meta(c, main_rid=None, assoc_rid=None) -> None:
+# Schedules whose origins/destinations need working out again, and locations whose names or categories have changed
+# (meaning any schedule starting or ending there does too)
+DIRTY_RIDS = set()
+DIRTY_TIPLOCS = set()
+# Marks only live in memory, so whatever changed just before a restart is caught by renewing everything once
+_all_dirty = [False]
+_dirty_lock = threading.Lock()
+
+DIRTY_CHUNK_SIZE = 1000
+
+
+def mark_dirty(rids=(), tiplocs=()) -> None:
+    with _dirty_lock:
+        DIRTY_RIDS.update(rids)
+        DIRTY_TIPLOCS.update(tiplocs)
+
+
+def mark_all_dirty() -> None:
+    with _dirty_lock:
+        _all_dirty[0] = True
+
+
+def _take_dirty(c) -> List[List[str]]:
+    """Schedules marked dirty, directly or through their locations, grouped with everything associated with them"""
+    with _dirty_lock:
+        rids, tiplocs = set(DIRTY_RIDS), list(DIRTY_TIPLOCS)
+        DIRTY_RIDS.clear()
+        DIRTY_TIPLOCS.clear()
+
+    try:
+        return _group_dirty(c, rids, tiplocs)
+    except Exception:
+        mark_dirty(rids, tiplocs)
+        raise
+
+
+def _group_dirty(c, rids, tiplocs) -> List[List[str]]:
+    if tiplocs:
+        c.execute("""SELECT DISTINCT rid FROM darwin_schedule_locations
+            WHERE tiploc=ANY(%s) AND type IN ('OR', 'OPOR', 'DT', 'OPDT');""", (tiplocs,))
+        rids.update([a[0] for a in c.fetchall()])
+
+    if not rids:
+        return []
+
+    # Associated schedules carry copies of each other's origins/destinations, and pass them on down chains of
+    # associations, so everything connected to a dirty schedule has to be reset and associated again with it, in the
+    # same go. Each group's named for the first rid in it
+    c.execute("""WITH RECURSIVE connected(seed, rid) AS (
+            SELECT rid, rid FROM unnest(%s::char(15)[]) AS rid
+            UNION
+            SELECT connected.seed, CASE WHEN a.main_rid=connected.rid THEN a.assoc_rid ELSE a.main_rid END
+            FROM darwin_associations AS a INNER JOIN connected ON connected.rid IN (a.main_rid, a.assoc_rid)
+            WHERE a.category!='NP')
+        SELECT connected.rid, min(groups.first) FROM connected
+        INNER JOIN (SELECT seed, min(rid) AS first FROM connected GROUP BY seed) AS groups USING (seed)
+        GROUP BY connected.rid;""", (list(rids),))
+
+    groups = {}
+    for rid, first in c.fetchall():
+        groups.setdefault(first, []).append(rid)
+    return [sorted(groups[a]) for a in sorted(groups)]
+
+
+def renew_dirty_schedule_meta(c) -> None:
+    """renew_schedule_meta, for only the schedules marked dirty since the last run, or every schedule after
+    mark_all_dirty"""
+    with _dirty_lock:
+        renew_all, _all_dirty[0] = _all_dirty[0], False
+        if renew_all:
+            # The rebuild covers everything marked so far, anything marked from here on is kept for next time
+            DIRTY_RIDS.clear()
+            DIRTY_TIPLOCS.clear()
+    if renew_all:
+        try:
+            renew_schedule_meta(c)
+            c.connection.commit()
+        except Exception:
+            mark_all_dirty()
+            raise
+        return
+
+    # Chunks are made of whole groups, so associated schedules are never renewed apart
+    chunks, chunk = [], []
+    for group in _take_dirty(c):
+        if chunk and len(chunk) + len(group) > DIRTY_CHUNK_SIZE:
+            chunks.append(chunk)
+            chunk = []
+        chunk += group
+    if chunk:
+        chunks.append(chunk)
+    if not chunks:
+        return
+
+    log.info("Computing origin/destination lists for {} changed schedules".format(sum(map(len, chunks))))
+    for n, chunk in enumerate(chunks):
+        try:
+            renew_schedule_meta(c, chunk)
+            # Row locks are only held a chunk at a time. Committed through psycopg2 rather than with COMMIT; so it
+            # begins a transaction again for the next chunk's server-side cursor
+            c.connection.commit()
+        except Exception:
+            # Try these again next time
+            mark_dirty([a for b in chunks[n:] for a in b])
+            raise
+
+
+# Associated services' origins/destinations, tagged with where and how they're associated, are appended onto each
+# schedule's own, unless that association's already been applied. {} is where the associations are narrowed down.
+# A single UPDATE only updates each row once, so additions are gathered per rid first
+_ASSOCIATION_DESTINATIONS = """WITH additions AS (
+    SELECT a.main_rid AS rid, array_agg((d.location::jsonb || jsonb_build_object(
+        'association_tiploc', a.tiploc, 'source', a.category::text))::json ORDER BY a.tiploc, a.assoc_rid, d.n) AS locations
+    FROM darwin_associations AS a
+    INNER JOIN darwin_schedules AS s1 on s1.rid=a.main_rid
+    INNER JOIN darwin_schedules AS s2 on s2.rid=a.assoc_rid
+    CROSS JOIN LATERAL unnest(s2.destinations) WITH ORDINALITY AS d(location, n)
+    WHERE a.category!='NP' {} AND NOT EXISTS (SELECT * FROM unnest(s1.destinations) AS e(location)
+        WHERE e.location->>'association_tiploc'=a.tiploc AND e.location->>'source'=a.category::text)
+    GROUP BY a.main_rid)
+UPDATE darwin_schedules AS s SET destinations=s.destinations || additions.locations
+    FROM additions WHERE s.rid=additions.rid;"""
+
+_ASSOCIATION_ORIGINS = """WITH additions AS (
+    SELECT a.assoc_rid AS rid, array_agg((o.location::jsonb || jsonb_build_object(
+        'association_tiploc', a.tiploc, 'source', a.category::text))::json ORDER BY a.tiploc, a.main_rid, o.n) AS locations
+    FROM darwin_associations AS a
+    INNER JOIN darwin_schedules AS s1 on s1.rid=a.main_rid
+    INNER JOIN darwin_schedules AS s2 on s2.rid=a.assoc_rid
+    CROSS JOIN LATERAL unnest(s1.origins) WITH ORDINALITY AS o(location, n)
+    WHERE a.category!='NP' {} AND NOT EXISTS (SELECT * FROM unnest(s2.origins) AS e(location)
+        WHERE e.location->>'association_tiploc'=a.tiploc AND e.location->>'source'=a.category::text)
+    GROUP BY a.assoc_rid)
+UPDATE darwin_schedules AS s SET origins=s.origins || additions.locations
+    FROM additions WHERE s.rid=additions.rid;"""
+
+
+def renew_schedule_association_meta(c, main_rid=None, assoc_rid=None, rids=None) -> None:
+    """For every association, or just the one between main_rid and assoc_rid, or just those involving any of rids.
+    Done in the database, unless meta_association_sql is turned off"""
+    if not config.get("meta_association_sql", True):
+        _renew_schedule_association_meta_rows(c, main_rid, assoc_rid, rids)
+        return
+
+    if main_rid and assoc_rid:
+        condition, params = "AND a.main_rid=%s AND a.assoc_rid=%s", (main_rid, assoc_rid)
+    elif rids is not None:
+        condition, params = "AND (a.main_rid=ANY(%s) OR a.assoc_rid=ANY(%s))", (list(rids), list(rids))
+    else:
+        condition, params = "", ()
+
+    c.execute(_ASSOCIATION_DESTINATIONS.format(condition), params)
+    c.execute(_ASSOCIATION_ORIGINS.format(condition), params)
+
+
+def _renew_schedule_association_meta_rows(c, main_rid=None, assoc_rid=None, rids=None) -> None:
+    # The original, row at a time version of the above
     if main_rid and assoc_rid:
         c.execute("""SELECT a.category,tiploc,s1.rid,s1.origins,s1.destinations,s2.rid,s2.origins,s2.destinations
             FROM darwin_associations AS a
             INNER JOIN darwin_schedules AS s1 on s1.rid=a.main_rid
             INNER JOIN darwin_schedules AS s2 on s2.rid=a.assoc_rid
             WHERE a.category!='NP' AND main_rid=%s AND assoc_rid=%s;""", (main_rid, assoc_rid))
+    elif rids is not None:
+        c.execute("""SELECT a.category,tiploc,s1.rid,s1.origins,s1.destinations,s2.rid,s2.origins,s2.destinations
+            FROM darwin_associations AS a
+            INNER JOIN darwin_schedules AS s1 on s1.rid=a.main_rid
+            INNER JOIN darwin_schedules AS s2 on s2.rid=a.assoc_rid
+            WHERE a.category!='NP' AND (main_rid=ANY(%s) OR assoc_rid=ANY(%s));""", (list(rids), list(rids)))
     else:
         c.execute("""SELECT a.category,tiploc,s1.rid,s1.origins,s1.destinations,s2.rid,s2.origins,s2.destinations
             FROM darwin_associations AS a
@@ -43,42 +206,61 @@ def renew_schedule_association_meta(c, main_rid=None, assoc_rid=None) -> None:
         if not any([a.get("association_tiploc")==row["tiploc"] and a["source"]==row["category"] for a in row["assoc_origins"]]):
             c.execute("""UPDATE darwin_schedules SET origins=darwin_schedules.origins || %s::json[] WHERE rid=%s;""", (row["main_origins"],row["assoc_rid"]))
 
-def renew_schedule_meta(c) -> None:
-    log.info("Computing origin/destination lists for schedules")
+def renew_schedule_meta(c, rids=None) -> None:
+    """Work out origins and destinations for every schedule, or just those in rids"""
+    if rids is None:
+        log.info("Computing origin/destination lists for schedules")
 
     crid = None
     origins = []
     destinations = []
     batch = []
+    batch_size = config.get("meta_batch_size", 100)
 
-    c.execute("""SELECT type,activity,cancelled,loc.rid,tiploc FROM darwin_schedule_locations as loc
-        INNER JOIN darwin_schedules AS s ON s.rid=loc.rid
-        WHERE type='OR' OR type='OPOR' OR type='DT' OR type='OPDT' ORDER BY rid DESC, index ASC;""")
+    # Streamed through a server-side cursor, rather than fetching every endpoint in the database at once
+    with c.connection.cursor(name="renew_schedule_meta") as locations:
+        locations.itersize = config.get("meta_itersize", 2000)
 
-    for i,row in enumerate(c.fetchall()):
-        row = list(row)[::-1]
-        row = OrderedDict([(a, row.pop()) for a in ("type", "activity", "canc", "rid", "tiploc")])
-        if row["rid"]!=crid:
-            batch.append((origins, destinations, crid))
-            origins,destinations = [],[]
+        if rids is None:
+            locations.execute("""SELECT type,activity,cancelled,loc.rid,tiploc FROM darwin_schedule_locations as loc
+                INNER JOIN darwin_schedules AS s ON s.rid=loc.rid
+                WHERE type='OR' OR type='OPOR' OR type='DT' OR type='OPDT' ORDER BY rid DESC, index ASC;""")
+        else:
+            locations.execute("""SELECT type,activity,cancelled,loc.rid,tiploc FROM darwin_schedule_locations as loc
+                INNER JOIN darwin_schedules AS s ON s.rid=loc.rid
+                WHERE (type='OR' OR type='OPOR' OR type='DT' OR type='OPDT') AND loc.rid=ANY(%s)
+                ORDER BY rid DESC, index ASC;""", (list(rids),))
 
-        crid=row["rid"]
+        for row in locations:
+            row = list(row)[::-1]
+            row = OrderedDict([(a, row.pop()) for a in ("type", "activity", "canc", "rid", "tiploc")])
+            if row["rid"]!=crid and crid is not None:
+                batch.append((origins, destinations, crid))
+                origins,destinations = [],[]
 
-        loc_dict = OrderedDict([("source", "SC"), ("type", row["type"]), ("activity", row["activity"]), ("cancelled", row["canc"])])
-        loc_dict.update(LOCATIONS[row["tiploc"]])
-        loc_dict = query.process_location_outline(loc_dict)
+                if len(batch) >= batch_size:
+                    psycopg2.extras.execute_batch(c, "UPDATE darwin_schedules SET (origins,destinations)=(%s::json[],%s::json[]) WHERE rid=%s;", batch)
+                    batch = []
 
-        if row["type"][-2:]=="OR":
-            origins.append(json.dumps(loc_dict))
-        elif row["type"][-2:]=="DT":
-            destinations.append(json.dumps(loc_dict))
+            crid=row["rid"]
 
-        if not i%100:
-            psycopg2.extras.execute_batch(c, "UPDATE darwin_schedules SET (origins,destinations)=(%s::json[],%s::json[]) WHERE rid=%s;", batch)
-            batch = []
+            loc_dict = OrderedDict([("source", "SC"), ("type", row["type"]), ("activity", row["activity"]), ("cancelled", row["canc"])])
+            loc_dict.update(LOCATIONS[row["tiploc"]])
+            loc_dict = query.process_location_outline(loc_dict)
 
-    psycopg2.extras.execute_batch(c, "UPDATE darwin_schedules SET (origins,destinations)=(%s::json[],%s::json[]) WHERE rid=%s;", batch)
+            if row["type"][-2:]=="OR":
+                origins.append(json.dumps(loc_dict))
+            elif row["type"][-2:]=="DT":
+                destinations.append(json.dumps(loc_dict))
 
-    log.info("Precompution of origin/destination lists completed, adding associations")
-    renew_schedule_association_meta(c)
-    log.info("All origin and destination lists have been completed")
+    if crid is not None:
+        batch.append((origins, destinations, crid))
+    if batch:
+        psycopg2.extras.execute_batch(c, "UPDATE darwin_schedules SET (origins,destinations)=(%s::json[],%s::json[]) WHERE rid=%s;", batch)
+
+    if rids is None:
+        log.info("Precompution of origin/destination lists completed, adding associations")
+        renew_schedule_association_meta(c)
+        log.info("All origin and destination lists have been completed")
+    else:
+        renew_schedule_association_meta(c, rids=rids)
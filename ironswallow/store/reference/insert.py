@@ -1,12 +1,27 @@
 from collections import OrderedDict
-import json
+import json, logging, os, pickle
+
+import psycopg2.extras
 
 from main import REASONS, LOCATIONS
 from . import category
 from . import names
+from ironswallow.store import meta
+from ironswallow.util import query
 
 from ironswallow.bplan import LOCALISED_OTHER_REFERENCES, BPLAN_NAMES
 
+log = logging.getLogger("IronSwallow")
+
+CORPUS_PATH = "datasets/corpus.json"
+CORPUS_FIELDS = ("3ALPHA", "NLCDESC")
+
+# The version (mtime and size) of corpus.json last loaded, and its index
+_CORPUS = [None, {}]
+
+# Which reference file LOCATIONS and REASONS were last built from, and from what local inputs
+REFERENCE_STATE = {}
+
 LOCALISED_OTHER_REFERENCES.extend([
     ("IS", "en_gb", "OPCAT", "S", "Mainline operator"),
     ("IS", "en_gb", "OPCAT", "M", "Non-NR operator"),
@@ -30,14 +45,83 @@ def toc_category_for(toc):
         return "O"
     return "S"
 
+def load_corpus(path=CORPUS_PATH) -> dict:
+    """CORPUS' TIPLOCDATA keyed by TIPLOC, with only the fields used here. It's only read again when the file changes,
+    and then from the index pickled next to it if that was made from the same version"""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if _CORPUS[0] == version:
+        return _CORPUS[1]
+
+    index_path = path + ".pickle"
+    try:
+        with open(index_path, "rb") as f:
+            index_version, corpus = pickle.load(f)
+    except FileNotFoundError:
+        index_version = None
+    except Exception as e:
+        log.warning("Ignoring unreadable CORPUS index: {}".format(e))
+        index_version = None
+
+    if index_version != version:
+        with open(path, encoding="iso-8859-1") as f:
+            corpus = {a["TIPLOC"]: {k: a.get(k) for k in CORPUS_FIELDS} for a in json.load(f)["TIPLOCDATA"]}
+        try:
+            with open(index_path + ".tmp", "wb") as f:
+                pickle.dump((version, corpus), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(index_path + ".tmp", index_path)
+        except OSError as e:
+            log.warning("Couldn't save CORPUS index: {}".format(e))
+
+    _CORPUS[:] = version, corpus
+    return corpus
+
+
+def save_cache(path, state) -> None:
+    """Remember state as what LOCATIONS and REASONS were just built from, and write all three to path"""
+    REFERENCE_STATE.clear()
+    REFERENCE_STATE.update(state)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"state": REFERENCE_STATE, "locations": LOCATIONS,
+                   "reasons": [[*k, v] for k, v in REASONS.items()]}, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_cache(c, path) -> None:
+    """Start from the last reference data stored, as long as the database still has it, so an unchanged reference
+    file needn't be downloaded, parsed and stored again. This has to fill the LOCATIONS and REASONS imported here: run
+    as a script, main is loaded twice, and only the copy imported as main is what the store reads"""
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        log.exception(e)
+        return
+
+    c.execute("SELECT EXISTS (SELECT * FROM darwin_locations);")
+    if not c.fetchone()[0]:
+        return
+
+    LOCATIONS.update(cache["locations"])
+    REASONS.update({(code, type_): message for code, type_, message in cache["reasons"]})
+    REFERENCE_STATE.update(cache["state"])
+    log.info("Loaded reference data for {} from cache".format(REFERENCE_STATE.get("key")))
+
+
 def store(c, parsed) -> None:
     strip = lambda x: x.rstrip() or None if x else None
 
     c.execute("DELETE FROM swallow_debug WHERE subsystem='NSUB';")
 
-    with open("datasets/corpus.json", encoding="iso-8859-1") as f:
-        corpus = json.load(f)["TIPLOCDATA"]
-    corpus = {a["TIPLOC"]: a for a in corpus}
+    corpus = load_corpus()
+
+    # Locations whose names or categories changed, so schedules starting or ending there need their meta renewed
+    changed = []
+
+    # Rows are keyed so a repeated reference replaces the earlier one, one upsert can't touch the same row twice
+    locations, operators, reasons = OrderedDict(), OrderedDict(), OrderedDict()
 
     for reference in parsed["PportTimetableRef"]["list"]:
         if reference["tag"] == "LocationRef":
@@ -61,32 +145,40 @@ def store(c, parsed) -> None:
             loc["category"] = category.category_for(loc)
             loc["name_short"], loc["name_full"] = names.name_for(loc, c)
 
-            c.execute("""INSERT INTO darwin_locations VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT(tiploc) DO UPDATE SET
-                (tiploc, crs_darwin, crs_corpus, operator, name_darwin, name_corpus, category, name_short, name_full,
-                name_bplan)=
-                (EXCLUDED.tiploc,EXCLUDED.crs_darwin,EXCLUDED.crs_corpus,
-                EXCLUDED.operator,EXCLUDED.name_darwin,EXCLUDED.name_corpus, EXCLUDED.category,
-                EXCLUDED.name_short, EXCLUDED.name_full, EXCLUDED.name_bplan);
-                """, (loc["tiploc"], loc["crs_darwin"], loc["crs_corpus"], loc["operator"],
+            locations[loc["tiploc"]] = (loc["tiploc"], loc["crs_darwin"], loc["crs_corpus"], loc["operator"],
                     loc["name_short"], loc["name_full"],
                     json.dumps(loc), loc["category"], loc["name_darwin"], loc["name_corpus"],
-                      BPLAN_NAMES.get(loc["tiploc"])))
+                      BPLAN_NAMES.get(loc["tiploc"]))
 
+            previous = LOCATIONS.get(reference["tpl"])
+            if previous and query.process_location_outline(previous) != query.process_location_outline(loc):
+                changed.append(reference["tpl"])
             LOCATIONS[reference["tpl"]] = loc
 
         if reference["tag"]=="TocRef":
-            c.execute("""INSERT INTO darwin_operators VALUES (%s, %s, %s, %s) ON CONFLICT (operator)
-                DO UPDATE SET (operator_name, url, category)=(EXCLUDED.operator_name, EXCLUDED.url, EXCLUDED.category);""",
-                (reference["toc"], reference["tocname"], reference.get("url"), toc_category_for(reference["toc"])))
+            operators[reference["toc"]] = (reference["toc"], reference["tocname"], reference.get("url"), toc_category_for(reference["toc"]))
 
         if reference["tag"] in ["CancellationReasons", "LateRunningReasons"]:
             reason_type = "C"*(reference["tag"]=="CancellationReasons") or "D"
             for reason in reference["list"]:
                 if reason["tag"]=="Reason":
-                    c.execute("""INSERT INTO darwin_reasons VALUES (%s, %s, %s) ON CONFLICT (id, type) DO UPDATE
-                        SET (type, message)=(EXCLUDED.type, EXCLUDED.message);""",
-                        (reason["code"], reason_type, reason["reasontext"]))
+                    reasons[(reason["code"], reason_type)] = (reason["code"], reason_type, reason["reasontext"])
                     REASONS[(reason["code"], reason_type)] = reason["reasontext"]
 
+    psycopg2.extras.execute_values(c, """INSERT INTO darwin_locations VALUES %s
+        ON CONFLICT(tiploc) DO UPDATE SET
+        (tiploc, crs_darwin, crs_corpus, operator, name_darwin, name_corpus, category, name_short, name_full,
+        name_bplan)=
+        (EXCLUDED.tiploc,EXCLUDED.crs_darwin,EXCLUDED.crs_corpus,
+        EXCLUDED.operator,EXCLUDED.name_darwin,EXCLUDED.name_corpus, EXCLUDED.category,
+        EXCLUDED.name_short, EXCLUDED.name_full, EXCLUDED.name_bplan);""", list(locations.values()), page_size=1000)
+    psycopg2.extras.execute_values(c, """INSERT INTO darwin_operators VALUES %s ON CONFLICT (operator)
+        DO UPDATE SET (operator_name, url, category)=(EXCLUDED.operator_name, EXCLUDED.url, EXCLUDED.category);""",
+        list(operators.values()))
+    psycopg2.extras.execute_values(c, """INSERT INTO darwin_reasons VALUES %s ON CONFLICT (id, type) DO UPDATE
+        SET (type, message)=(EXCLUDED.type, EXCLUDED.message);""", list(reasons.values()))
+
     c.execute("COMMIT;")
+
+    if changed:
+        meta.mark_dirty(tiplocs=changed)
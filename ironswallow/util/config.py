@@ -8,7 +8,7 @@ for config_path in ("config.json", "secret.json"):
     try:
         with open(config_path) as f:
             config.update(json.load(f))
-    except e:
+    except FileNotFoundError:
         pass
 
 def get(key, default=None):
@@ -0,0 +1,110 @@
+import datetime, logging, threading
+from typing import List, Optional
+
+from ironswallow.util import metrics
+
+log = logging.getLogger("IronSwallow")
+
+# Darwin's sequence numbers go back round to 0 after 9999999
+SEQUENCE_WRAP = 10000000
+# Falling further behind than this is taken as the sequence starting over, rather than a redelivery
+SEQUENCE_REDELIVERY_WINDOW = 10000
+
+CREATE_LAG_TABLE = """CREATE TABLE IF NOT EXISTS darwin_lag (
+    minute TIMESTAMP NOT NULL PRIMARY KEY,
+    messages INTEGER NOT NULL,
+    p50 REAL,
+    p90 REAL,
+    p99 REAL,
+    max REAL,
+    sequence_gaps INTEGER NOT NULL,
+    sequence_missing INTEGER NOT NULL
+);"""
+
+INSERT_LAG_ROW = """INSERT INTO darwin_lag VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (minute) DO UPDATE SET
+    (messages, p50, p90, p99, max, sequence_gaps, sequence_missing)=
+    (EXCLUDED.messages, EXCLUDED.p50, EXCLUDED.p90, EXCLUDED.p99, EXCLUDED.max, EXCLUDED.sequence_gaps, EXCLUDED.sequence_missing);"""
+
+metrics.describe("ironswallow_lag_seconds", "Time between Darwin generating the most recently committed message and its commit")
+metrics.describe("ironswallow_commit_lag_seconds", "Time between Darwin generating a message and its commit")
+metrics.describe("ironswallow_sequence_gaps_total", "Times the STOMP sequence number skipped ahead")
+metrics.describe("ironswallow_sequence_missing_total", "Sequence numbers skipped over")
+metrics.describe("ironswallow_sequence_repeats_total", "Messages at or behind the last sequence number, usually redeliveries")
+
+
+def _percentile(ordered, fraction) -> float:
+    return ordered[min(len(ordered)-1, int(fraction*len(ordered)))]
+
+
+def _minute(time) -> datetime.datetime:
+    return time.replace(second=0, microsecond=0)
+
+
+class LagTracker:
+    """How far behind Darwin we are, measured from the ts Darwin stamps on each Pport to when the message is committed,
+    and whether any sequence numbers went missing on the way. With minutes, lags are also collected into per-minute
+    percentiles for the darwin_lag table"""
+
+    def __init__(self, minutes=False):
+        self.last_sequence = None
+        self.lag = None
+        self._minutes = minutes
+        self._lock = threading.Lock()
+        # minute -> [lags], [gaps, missing]
+        self._lags = {}
+        self._gaps = {}
+
+        metrics.gauge("ironswallow_lag_seconds", lambda: float("nan") if self.lag is None else self.lag)
+        metrics.gauge("ironswallow_last_sequence", lambda: float("nan") if self.last_sequence is None else self.last_sequence)
+
+    def received(self, sequence: int) -> None:
+        if self.last_sequence is not None:
+            missing = (sequence - self.last_sequence - 1) % SEQUENCE_WRAP
+            if missing >= SEQUENCE_WRAP//2:
+                if (self.last_sequence - sequence) % SEQUENCE_WRAP < SEQUENCE_REDELIVERY_WINDOW:
+                    metrics.count("ironswallow_sequence_repeats_total")
+                    return
+                log.warning("Sequence number went back from {} to {}, starting over".format(self.last_sequence, sequence))
+            elif missing:
+                log.warning("Sequence number gap, {} message(s) missing between {} and {}".format(
+                    missing, self.last_sequence, sequence))
+                metrics.count("ironswallow_sequence_gaps_total")
+                metrics.count("ironswallow_sequence_missing_total", missing)
+                if self._minutes:
+                    with self._lock:
+                        gaps = self._gaps.setdefault(_minute(datetime.datetime.utcnow()), [0, 0])
+                        gaps[0] += 1
+                        gaps[1] += missing
+        self.last_sequence = sequence
+
+    def committed(self, generated: List[Optional[datetime.datetime]]) -> None:
+        """Called once the messages Darwin generated at these times have been committed"""
+        now = datetime.datetime.utcnow()
+        lags = [(now - a).total_seconds() for a in generated if a]
+        if not lags:
+            return
+
+        for lag in lags:
+            metrics.observe("ironswallow_commit_lag_seconds", lag)
+        self.lag = lags[-1]
+
+        if self._minutes:
+            with self._lock:
+                self._lags.setdefault(_minute(now), []).extend(lags)
+
+    def completed_minutes(self) -> List[tuple]:
+        """darwin_lag rows for every minute before this one not already returned"""
+        current = _minute(datetime.datetime.utcnow())
+        with self._lock:
+            minutes = sorted([a for a in self._lags.keys() | self._gaps.keys() if a < current])
+            lags = [sorted(self._lags.pop(a, [])) for a in minutes]
+            gaps = [self._gaps.pop(a, [0, 0]) for a in minutes]
+
+        rows = []
+        for minute, ordered, (gap_count, missing) in zip(minutes, lags, gaps):
+            if ordered:
+                rows.append((minute, len(ordered), _percentile(ordered, 0.5), _percentile(ordered, 0.9),
+                             _percentile(ordered, 0.99), ordered[-1], gap_count, missing))
+            else:
+                rows.append((minute, 0, None, None, None, None, gap_count, missing))
+        return rows
@@ -0,0 +1,126 @@
+import bisect, logging, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+log = logging.getLogger("IronSwallow")
+
+# Seconds. Most of what gets timed is well under a millisecond, commits and backed up queues are not
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_help = {}
+
+
+def describe(name, text) -> None:
+    _help[name] = text
+
+
+def count(name, amount=1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # A count per bucket (the last being +Inf), and the sum
+            histogram = _histograms[key] = [[0]*(len(BUCKETS)+1), 0.0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+
+def gauge(name, func: Callable[[], float]) -> None:
+    """Register func to be called for name's value whenever metrics are rendered"""
+    _gauges[name] = func
+
+
+def message_tag(records) -> str:
+    """Label for a message by what it carried, "mixed" if there's more than one kind of record"""
+    tags = {a["tag"] for a in records}
+    if len(tags) == 1:
+        return next(iter(tags))
+    return "mixed" if tags else "empty"
+
+
+def _labels(labels, *extra) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(['{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs]) + "}"
+
+
+def _header(out, name, type_) -> None:
+    if name in _help:
+        out.append("# HELP {} {}".format(name, _help[name]))
+    out.append("# TYPE {} {}".format(name, type_))
+
+
+def render() -> str:
+    """Everything collected so far, in Prometheus' text exposition format"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: (list(v[0]), v[1]) for k, v in _histograms.items()}
+
+    out = []
+    last_name = None
+    for (name, labels), value in sorted(counters.items()):
+        if name != last_name:
+            _header(out, name, "counter")
+            last_name = name
+        out.append("{}{} {}".format(name, _labels(labels), value))
+
+    for (name, labels), (buckets, total) in sorted(histograms.items()):
+        if name != last_name:
+            _header(out, name, "histogram")
+            last_name = name
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ("+Inf",), buckets):
+            cumulative += bucket_count
+            out.append("{}_bucket{} {}".format(name, _labels(labels, ("le", bound)), cumulative))
+        out.append("{}_sum{} {}".format(name, _labels(labels), total))
+        out.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+
+    for name, func in sorted(_gauges.items()):
+        try:
+            value = func()
+        except Exception as e:
+            log.exception(e)
+            continue
+        _header(out, name, "gauge")
+        out.append("{} {}".format(name, value))
+
+    return "\n".join(out) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out everything else on stderr
+        pass
+
+
+def serve(port, host="127.0.0.1") -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics on a daemon thread, returns the server, or None if no port is given"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Serving metrics on {}:{}".format(host, port))
+    return server
@@ -0,0 +1,24 @@
+import datetime, io
+
+
+def copy_value(value) -> str:
+    """A value in PostgreSQL's COPY text format"""
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_buffer(rows) -> io.StringIO:
+    """Render rows in PostgreSQL's COPY text format"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join([copy_value(a) for a in row]))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
@@ -1,8 +1,7 @@
 import datetime
 from collections import OrderedDict
-from decimal import Decimal
-
 from ironswallow.util import database
+from ironswallow.util.times import day_rollover
 
 def json_default(value) -> str:
     if isinstance(value, datetime.datetime):
@@ -25,25 +24,11 @@ def process_location_outline(location) -> dict:
     return location
 
 
-def compare_time(t1, t2) -> int:
-    if not (t1 and t2):
-        return 0
-    t1,t2 = [a.hour*3600+a.minute*60+a.second for a in (t1,t2)]
-    return (Decimal(t1)-Decimal(t2))/3600
-
 def combine_darwin_time(working_time, darwin_time) -> datetime.datetime:
     if not working_time:
         return None
 
-    # Crossed midnight, increment ssd offset
-    if compare_time(darwin_time, working_time) < -6:
-        ssd_offset = +1
-    # Normal increase or decrease, nothing we really need to do here
-    elif -6 <= compare_time(darwin_time, working_time) <= +18:
-        ssd_offset = 0
-    # Back in time, crossed midnight (in reverse), decrement ssd offset
-    elif +18 < compare_time(darwin_time, working_time):
-        ssd_offset = -1
+    ssd_offset = day_rollover(darwin_time, working_time)
 
     return datetime.datetime.combine(working_time.date(), darwin_time) + datetime.timedelta(days=ssd_offset)
 
@@ -0,0 +1,69 @@
+import datetime
+from typing import Optional
+
+# There's only 86400 distinct times of day, so every one we see is parsed once and kept
+_TIMES = {}
+_WORKING_TIMES = {}
+
+
+def process_time(time: Optional[str]) -> Optional[datetime.time]:
+    """Parse a Darwin HH:MM or HH:MM:SS time"""
+    if not time:
+        return None
+    try:
+        return _TIMES[time]
+    except KeyError:
+        pass
+
+    if len(time) not in (5, 8) or time[2] != ":" or (len(time) == 8 and time[5] != ":"):
+        raise ValueError("Not a Darwin time: {}".format(time))
+    parsed = datetime.time(int(time[0:2]), int(time[3:5]), int(time[6:8] or 0))
+
+    _TIMES[time] = parsed
+    return parsed
+
+
+def process_date(date: str) -> datetime.date:
+    """Parse a Darwin YYYY-MM-DD date"""
+    return datetime.date.fromisoformat(date)
+
+
+def day_rollover(time, previous) -> int:
+    """Days to move time on from previous's date. Going back more than 6 hours means midnight was crossed (+1), going
+    forward more than 18 means it was crossed in reverse (-1). Either may be a datetime, only the time of day counts"""
+    if not (time and previous):
+        return 0
+    difference = (time.hour-previous.hour)*3600 + (time.minute-previous.minute)*60 + time.second-previous.second
+    if difference < -6*3600:
+        return +1
+    if difference > 18*3600:
+        return -1
+    return 0
+
+
+def working_time_part(time: Optional[datetime.time]) -> str:
+    """HHMMSS, or six spaces for a missing time, as used in original_wt"""
+    if not time:
+        return "      "
+    try:
+        return _WORKING_TIMES[time]
+    except KeyError:
+        part = _WORKING_TIMES[time] = time.strftime("%H%M%S")
+        return part
+
+
+def process_timestamp(ts: Optional[str]) -> Optional[datetime.datetime]:
+    """Parse a push port ts (as on Pport) into a naive UTC datetime, like utcnow(). Darwin sends seven fractional
+    digits, which fromisoformat won't take, so anything past microseconds is dropped"""
+    if not ts:
+        return None
+    parsed = datetime.datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+    rest = ts[19:]
+    if rest.startswith("."):
+        digits = len(rest) - len(rest[1:].lstrip("0123456789"))
+        parsed += datetime.timedelta(microseconds=int(rest[1:digits][:6].ljust(6, "0")))
+        rest = rest[digits:]
+    if rest and rest != "Z":
+        offset = datetime.timedelta(hours=int(rest[1:3]), minutes=int(rest[-2:]))
+        parsed -= offset if rest[0] == "+" else -offset
+    return parsed
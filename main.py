@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
-import logging, json, datetime, zlib, gzip, multiprocessing, ftplib, tempfile
-from time import sleep
-from typing import List
+import logging, json, datetime, zlib, gzip, multiprocessing, ftplib, tempfile, threading, contextlib, itertools, asyncio, queue, argparse
+import os, hashlib
+from time import sleep, perf_counter
+from typing import List, Tuple, Iterator, Optional
 
 import boto3
 import stomp
 
-from ironswallow.util import database, query
+from ironswallow.util import database, query, metrics, lag
+from ironswallow.util.times import process_timestamp
 from ironswallow.darwin import parse
 import ironswallow.store
 import ironswallow.bplan
@@ -16,20 +18,78 @@ from IronSwallowORM import models
 
 LOCATIONS = {}
 REASONS = {}
+REFERENCE_INPUTS = ("datasets/corpus.json", "datasets/bplan.txt")
+
+metrics.describe("ironswallow_stage_seconds", "Time spent decompressing, parsing and queueing STOMP messages, by record tag")
+metrics.describe("ironswallow_messages_total", "STOMP messages received, by record tag")
+metrics.describe("ironswallow_records_total", "Records received over STOMP, by tag")
+metrics.describe("ironswallow_stomp_inbox", "STOMP messages received but not yet picked up for storing")
+metrics.describe("ironswallow_stomp_paused", "1 while consumption is paused for the database queue to drain")
+metrics.describe("ironswallow_stomp_pauses_total", "Times consumption was paused for the database queue to drain")
 
 
 def incorporate_reference_data(c) -> None:
-    ironswallow.store.reference.insert.store(c, retrieve_reference_data(c))
+    retrieved = retrieve_reference_data(c)
+    if retrieved is None:
+        log.info("Reference data unchanged, skipping")
+        return
+
+    state, parsed = retrieved
+    ironswallow.store.reference.insert.store(c, parsed)
+    ironswallow.store.reference.insert.save_cache(SECRET.get("reference_cache", "datasets/reference_cache.json"), state)
 
 
-def retrieve_reference_data(c) -> List[dict]:
+def retrieve_reference_data(c) -> Optional[Tuple[dict, dict]]:
+    """The newest reference file, parsed, with the key, ETag and hash to remember it by, or None if it's what
+    LOCATIONS and REASONS were last built from"""
     client = boto3.client('s3', aws_access_key_id=SECRET["s3-access"], aws_secret_access_key=SECRET["s3-secret"])
     obj_list = client.list_objects(Bucket="darwin.xmltimetable")["Contents"]
     obj_list = [a for a in obj_list if "ref" in a["Key"]]
-    stream = client.get_object(Bucket="darwin.xmltimetable", Key=obj_list[-1]["Key"])["Body"]
-    parsed = parse.parse_xml(gzip.decompress(stream.read()))
+    remembered = ironswallow.store.reference.insert.REFERENCE_STATE
+
+    state = {"key": obj_list[-1]["Key"], "etag": obj_list[-1]["ETag"], "inputs": reference_inputs()}
+    if all([remembered.get(k) == v for k, v in state.items()]):
+        return None
+
+    # Decompressed and parsed as it downloads, so there's never more than a chunk of the file in memory. Hashing what
+    # comes out means an unchanged file is only noticed after parsing, but that's rare enough not to matter
+    digest = hashlib.sha256()
+    with gzip.GzipFile(fileobj=client.get_object(Bucket="darwin.xmltimetable", Key=state["key"])["Body"]) as f:
+        parsed = parse.parse_xml_chunks(hashed_chunks(f, digest))
+
+    state["hash"] = digest.hexdigest()
+    if remembered.get("hash") == state["hash"] and remembered.get("inputs") == state["inputs"]:
+        # Same content under a new key or ETag
+        remembered.update(state)
+        return None
+
+    return state, parsed
+
 
-    return parsed
+def hashed_chunks(f, digest, size=1 << 20) -> Iterator[bytes]:
+    for chunk in iter(lambda: f.read(size), b""):
+        digest.update(chunk)
+        yield chunk
+
+
+def reference_inputs() -> list:
+    """Sizes and modification times of the local files names and categories are worked out from"""
+    out = []
+    for path in REFERENCE_INPUTS:
+        try:
+            stat = os.stat(path)
+            out.append([path, stat.st_size, stat.st_mtime])
+        except FileNotFoundError:
+            out.append([path, None, None])
+    return out
+
+
+def windows(iterable, size) -> Iterator[list]:
+    iterator = iter(iterable)
+    window = list(itertools.islice(iterator, size))
+    while window:
+        yield window
+        window = list(itertools.islice(iterator, size))
 
 
 def incorporate_ftp(mp) -> None:
@@ -59,12 +119,19 @@ def incorporate_ftp(mp) -> None:
                     break
 
             log.info("Purging database")
-            mp.execute("BEGIN;")
+            mp.execute("BEGIN;", broadcast=True)
             mp.execute("ALTER TABLE darwin_schedules DISABLE TRIGGER USER;")
             mp.execute("TRUNCATE TABLE darwin_schedule_locations,darwin_schedule_status,darwin_associations,darwin_schedules,darwin_messages;")
             mp.execute("ALTER TABLE darwin_schedules ENABLE TRIGGER USER;")
 
-            with multiprocessing.Pool(8) as pool:
+            # Everything's just been truncated, so schedules can skip the per-rid reconciliation and go in by COPY
+            mp.begin_snapshot(SECRET.get("ftp_snapshot_flush_size", 10000))
+
+            chunk_size = SECRET.get("ftp_parse_chunk_size", 64)
+            processes = SECRET.get("ftp_parse_processes", 8)
+            window_size = chunk_size*processes*SECRET.get("ftp_parse_window_chunks", 4)
+
+            with multiprocessing.Pool(processes) as pool:
                 while actual_files:
                     file_name, file = actual_files[0]
                     log.info("Enqueueing retrieved file {}".format(file_name))
@@ -73,16 +140,19 @@ def incorporate_ftp(mp) -> None:
                     # Because those issues tend to be ones which abort the transaction
                     e2 = None
                     try:
-                        for idx,result in pool.imap(parse.parse_darwin_suppress, enumerate(gzip.open(file))):
-                            try:
-                                if type(result) == str:
-                                    logging.error("FTP message parse failed (line {})".format(idx))
-                                    logging.error(result)
-                                else:
-                                    mp.store(result)
-                            except Exception as e2:
-                                log.exception(e2)
-                                raise e2
+                        # Only a window of lines is handed to the pool at a time, otherwise imap reads the whole file in
+                        # and piles up parsed results faster than the database queue can take them
+                        for window in windows(enumerate(gzip.open(file)), window_size):
+                            for idx,result in pool.imap(parse.parse_darwin_suppress, window, chunk_size):
+                                try:
+                                    if type(result) == str:
+                                        logging.error("FTP message parse failed (line {})".format(idx))
+                                        logging.error(result)
+                                    else:
+                                        mp.store(result)
+                                except Exception as e2:
+                                    log.exception(e2)
+                                    raise e2
                     except Exception as e1:
                         if e2: raise e2
                         log.exception(e1)
@@ -90,7 +160,8 @@ def incorporate_ftp(mp) -> None:
                     file.close()
                     del actual_files[0]
 
-            mp.execute("COMMIT;")
+            mp.end_snapshot()
+            mp.commit()
             return
         except ftplib.Error as e:
             backoff = min(n**2, 600)
@@ -100,8 +171,10 @@ def incorporate_ftp(mp) -> None:
 
 
 class Listener(stomp.ConnectionListener):
-    def __init__(self, mp):
+    def __init__(self, mp, batch_size=1, batch_interval=0, lag_minutes=False, prefetch_size=None,
+                 high_watermark=500, low_watermark=100):
         self.processor = mp
+        self.lag = lag.LagTracker(lag_minutes)
         self._mq: stomp.Connection = None
         self.disconnected = True
         self._attempting_connection = False
@@ -109,27 +182,132 @@ class Listener(stomp.ConnectionListener):
         self._connection_attempts_total = 0
         self._last_connection_attempt = datetime.datetime(1989, 1, 1, 1, 1, 1)
 
-    def on_message(self, headers, message):
-        try:
-            self.processor.execute("BEGIN;")
+        # Messages are grouped into a single transaction until either limit is hit, then ACKed once that's committed
+        self._batch_size = batch_size
+        self._batch_interval = datetime.timedelta(milliseconds=batch_interval)
+        self._batch_lock = threading.Lock()
+        self._batch = []
+        self._batch_started = None
+        self._batch_sequence = None
+        self._commit_count = 0
+        self._commit_message_count = 0
+        self._commit_stats_last = (0, 0)
+
+        # stomp.py calls on_message from the thread that reads the socket, heartbeats included, so messages are handed
+        # straight over to an ingest thread. That thread stops taking them while the database queue is above the high
+        # watermark until it's back down to the low one. Not ACKing in the meantime means the broker stops sending once
+        # prefetch_size are outstanding, which is what keeps the inbox bounded
+        self._prefetch_size = prefetch_size
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._inbox = queue.Queue()
+        self.paused = False
+
+        if prefetch_size and prefetch_size < batch_size:
+            log.warning("STOMP prefetch size ({}) is below the batch size ({}), batches will only ever be committed by "
+                        "interval".format(prefetch_size, batch_size))
+
+        metrics.gauge("ironswallow_stomp_inbox", self._inbox.qsize)
+        metrics.gauge("ironswallow_stomp_paused", lambda: int(self.paused))
+        threading.Thread(target=self._ingest_thread, daemon=True).start()
 
-            message = zlib.decompress(message, zlib.MAX_WBITS | 32)
-    
+    def on_message(self, headers, message):
+        self._inbox.put((headers, message))
+
+    def _ingest_thread(self) -> None:
+        while True:
+            headers, message = self._inbox.get()
+            if self.processor.count() >= self._high_watermark:
+                self._wait_for_queue()
+            self._ingest(headers, message)
+
+    def _wait_for_queue(self) -> None:
+        self.paused = True
+        paused_at = perf_counter()
+        metrics.count("ironswallow_stomp_pauses_total")
+        log.info(f"Database queue ({self.processor.count()}) over high watermark, pausing consumption")
+        while self.processor.count() > self._low_watermark:
+            sleep(0.05)
+        log.info(f"Resuming consumption after {perf_counter()-paused_at:.1f}s")
+        self.paused = False
+
+    def _ingest(self, headers, message) -> None:
+        with self._batch_lock:
             try:
-                self.processor.store(parse.parse_darwin(message))
+                if self._batch_started is None:
+                    self.processor.execute("BEGIN;", broadcast=True)
+                    self._batch_started = datetime.datetime.utcnow()
+
+                started = perf_counter()
+                message = zlib.decompress(message, zlib.MAX_WBITS | 32)
+                decompressed = perf_counter()
+
+                tag = "unparsed"
+                generated = None
+                try:
+                    pport = parse.parse_pport(message)
+                    generated = process_timestamp(pport.get("ts"))
+                    parsed = parse.pport_records(pport)
+                    parsed_at = perf_counter()
+                    tag = metrics.message_tag(parsed)
+                    self.processor.store(parsed)
+
+                    metrics.observe("ironswallow_stage_seconds", parsed_at-decompressed, stage="parse", tag=tag)
+                    metrics.observe("ironswallow_stage_seconds", perf_counter()-parsed_at, stage="store", tag=tag)
+                    for record in parsed:
+                        metrics.count("ironswallow_records_total", tag=record["tag"])
+                except Exception as e:
+                    log.exception(e)
+                metrics.observe("ironswallow_stage_seconds", decompressed-started, stage="decompress", tag=tag)
+                metrics.count("ironswallow_messages_total", tag=tag)
+
+                self._batch.append((headers['message-id'], headers['subscription'], generated))
+                self._batch_sequence = headers["SequenceNumber"]
+                self.lag.received(int(self._batch_sequence))
+
+                if len(self._batch) >= self._batch_size:
+                    self._flush_batch()
             except Exception as e:
                 log.exception(e)
-            self._mq.ack(id=headers['message-id'], subscription=headers['subscription'])
-    
+
+    def flush_if_due(self) -> None:
+        """Commit the open batch if it's been waiting longer than the batch interval"""
+        with self._batch_lock:
+            if self._batch_started is not None and datetime.datetime.utcnow() - self._batch_started >= self._batch_interval:
+                self._flush_batch()
+
+    def _flush_batch(self) -> None:
+        if self._batch_sequence is not None:
             self.processor.execute("""INSERT INTO last_received_sequence VALUES (0, %s, %s)
                 ON CONFLICT (id)
                 DO UPDATE SET sequence=EXCLUDED.sequence, time_acquired=EXCLUDED.time_acquired;""", (
-                headers["SequenceNumber"], datetime.datetime.utcnow()))
-    
-            self.processor.execute("COMMIT;")
+                self._batch_sequence, datetime.datetime.utcnow()))
+
+        for row in self.lag.completed_minutes():
+            self.processor.execute(lag.INSERT_LAG_ROW, row)
+
+        self.processor.commit()
+        self.processor.call(self._ack, self._batch)
+        self._batch = []
+        self._batch_started = None
+
+    def _ack(self, batch) -> None:
+        # Called from the executor thread after the batch's COMMIT
+        self._commit_count += 1
+        self._commit_message_count += len(batch)
+        self.lag.committed([a[2] for a in batch])
+        try:
+            for message_id, subscription, _ in batch:
+                self._mq.ack(id=message_id, subscription=subscription)
         except Exception as e:
             log.exception(e)
-        
+
+    def commit_stats(self) -> Tuple[int, int]:
+        """Commits and committed messages since this was last called"""
+        totals = (self._commit_count, self._commit_message_count)
+        last, self._commit_stats_last = self._commit_stats_last, totals
+        return totals[0]-last[0], totals[1]-last[1]
+
     def on_error(self, headers, message: bytes):
         log.error('received an error "%s"' % message.split(b"\n")[0])
 
@@ -138,10 +316,17 @@ class Listener(stomp.ConnectionListener):
 
     def on_disconnected(self):
         log.error("Disconnected")
+        # These can't be ACKed on another connection, and the broker will be sending them again anyway
+        while True:
+            try:
+                self._inbox.get_nowait()
+            except queue.Empty:
+                break
         if not self._attempting_connection:
             self.disconnected = True
 
-    def connect_and_subscribe(self):
+    async def connect_and_subscribe(self):
+        """Backoff is awaited rather than slept, so nothing else on the event loop is held up while this retries"""
         if not self.disconnected and not self._attempting_connection:
             return
 
@@ -149,9 +334,10 @@ class Listener(stomp.ConnectionListener):
         self._connection_attempts = 0
         self._attempting_connection = True
 
-        if (datetime.datetime.utcnow()-self._last_connection_attempt).seconds < 10:
+        since_last = (datetime.datetime.utcnow()-self._last_connection_attempt).total_seconds()
+        if since_last < 10:
             log.info("Last connection attempt less than 10s ago, delaying")
-            sleep(10)
+            await asyncio.sleep(10-since_last)
 
 
         mq = stomp.Connection([(SECRET["hostname"], 61613)],
@@ -165,18 +351,8 @@ class Listener(stomp.ConnectionListener):
             self._last_connection_attempt = datetime.datetime.utcnow()
             try:
                 log.info("Connecting... (attempt %s)" % n)
-                mq.connect(**{
-                    "username": SECRET["username"],
-                    "passcode": SECRET["password"],
-                    "wait": True,
-                    "client-id": SECRET["username"],
-                })
-                mq.subscribe(**{
-                    "destination": SECRET["subscribe"],
-                    "id": 1,
-                    "ack": "client-individual",
-                    "activemq.subscriptionName": SECRET["identifier"],
-                })
+                # stomp.py only does blocking connects
+                await asyncio.get_running_loop().run_in_executor(None, self._connect, mq)
                 log.info("Connected!")
                 self._attempting_connection = False
                 return
@@ -184,11 +360,26 @@ class Listener(stomp.ConnectionListener):
                 backoff = max(min(n ** 2, 600), 10)
                 log.error("Failed to connect, waiting {}s".format(backoff))
                 log.exception(e)
-                sleep(backoff)
+                await asyncio.sleep(backoff)
         log.error("Connection attempts exhausted")
         self.disconnected = True
         self._attempting_connection = False
 
+    def _connect(self, mq) -> None:
+        mq.connect(**{
+            "username": SECRET["username"],
+            "passcode": SECRET["password"],
+            "wait": True,
+            "client-id": SECRET["username"],
+        })
+        mq.subscribe(**{
+            "destination": SECRET["subscribe"],
+            "id": 1,
+            "ack": "client-individual",
+            "activemq.subscriptionName": SECRET["identifier"],
+            **({"activemq.prefetchSize": self._prefetch_size} if self._prefetch_size else {}),
+        })
+
     def is_disconnected(self):
         # Check the STOMP object itself
         # Check our semaphore
@@ -203,7 +394,80 @@ class Listener(stomp.ConnectionListener):
         return not self._mq and self.disconnected and self._connection_attempts_total == 0
 
 
+async def periodic(interval, func, *args, delay=0, blocking=False) -> None:
+    """Call func every interval seconds, after waiting delay. Blocking functions are run on the default executor, so
+    they don't hold up the event loop. A run that overruns pushes the next one back rather than overlapping it"""
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(delay)
+    while True:
+        started = loop.time()
+        try:
+            if blocking:
+                await loop.run_in_executor(None, func, *args)
+            else:
+                func(*args)
+        except Exception as e:
+            log.exception(e)
+        await asyncio.sleep(max(interval - (loop.time()-started), 0))
+
+
+async def keep_connected(listener) -> None:
+    while True:
+        if listener.is_disconnected() or listener.is_before_first_connection():
+            await listener.connect_and_subscribe()
+        await asyncio.sleep(1)
+
+
+def refresh_reference_data() -> None:
+    # A connection of its own, so the refresh's transaction is never mixed up with anything the processor's doing
+    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
+        incorporate_reference_data(c)
+
+
+def renew_meta() -> None:
+    # On a connection of its own, its server-side cursor wouldn't survive the listener's commits
+    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
+        ironswallow.store.meta.renew_dirty_schedule_meta(c)
+
+
+def check_queue(mp) -> None:
+    if mp.count() > 500:
+        log.info(f"Database queue count ({mp.count()}) over limit.")
+
+
+def log_commit_stats(listener, interval) -> None:
+    commits, messages = listener.commit_stats()
+    current_lag = "?" if listener.lag.lag is None else f"{listener.lag.lag:.1f}"
+    log.info(f"{commits/interval:.2f} commits/s, {messages/interval:.2f} messages/s, {current_lag}s behind")
+
+
+async def service(mp, listener) -> None:
+    """Everything that happens once startup's done. The STOMP listener and database writers have threads of their own,
+    the periodic jobs here are scheduled on the event loop and the slow ones handed off to the executor"""
+    tasks = [
+        periodic(3600, refresh_reference_data, delay=3600, blocking=True),
+        periodic(SECRET.get("meta_renew_interval", 300), renew_meta, delay=1, blocking=True),
+        periodic(30, check_queue, mp, delay=30),
+    ]
+
+    if listener:
+        # Taking the batch lock can mean waiting for a message to be queued, which can wait on the database
+        flush_interval = min(SECRET.get("stomp_batch_interval", 0)/1000 or 1, 1)
+        tasks += [
+            keep_connected(listener),
+            periodic(flush_interval, listener.flush_if_due, blocking=True),
+            periodic(60, log_commit_stats, listener, 60, delay=60),
+        ]
+
+    await asyncio.gather(*tasks)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--renew-schedule-meta", action="store_true",
+                        help="Rebuild origins and destinations for every schedule, rather than only changed ones, and exit")
+    args = parser.parse_args()
+
     fh = logging.FileHandler('logs/swallow.log')
     ch = logging.StreamHandler()
     ch.setLevel(logging.DEBUG)
@@ -225,13 +489,38 @@ if __name__ == "__main__":
         models.create_all(db_connection.engine)
 
 
-    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as cursor:
+    if args.renew_schedule_meta:
+        with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as cursor:
+            ironswallow.bplan.parse_store_bplan()
+            ironswallow.store.reference.insert.load_cache(cursor, SECRET.get("reference_cache", "datasets/reference_cache.json"))
+            incorporate_reference_data(cursor)
+            # The reference store ends with COMMIT;, which psycopg2 doesn't notice, so it wouldn't begin the transaction
+            # renew_schedule_meta's server-side cursor needs
+            db_connection.connection.commit()
+            ironswallow.store.meta.renew_schedule_meta(cursor)
+            db_connection.connection.commit()
+        exit(0)
+
+    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as cursor, contextlib.ExitStack() as pool:
         ironswallow.bplan.parse_store_bplan()
+        ironswallow.store.reference.insert.load_cache(cursor, SECRET.get("reference_cache", "datasets/reference_cache.json"))
         incorporate_reference_data(cursor)
 
+        if SECRET.get("lag_minute_table"):
+            cursor.execute(lag.CREATE_LAG_TABLE)
+            cursor.execute("COMMIT;")
+
         last_retrieved = query.last_retrieved(cursor)
 
-        with ironswallow.store.darwin.MessageProcessor(cursor) as mp:
+        # Extra connections for MessageProcessor to spread services across
+        pool_cursors = [pool.enter_context(pool.enter_context(database.DatabaseConnection()).new_cursor())
+                        for _ in range(SECRET.get("database_pool_size", 1)-1)]
+
+        with ironswallow.store.darwin.MessageProcessor(cursor, *pool_cursors,
+                schedule_cache_size=SECRET.get("schedule_cache_size", 50000)) as mp:
+            metrics.gauge("ironswallow_database_queue", mp.count)
+            metrics.serve(SECRET.get("metrics_port"), SECRET.get("metrics_host", "127.0.0.1"))
+
             if (not last_retrieved or (datetime.datetime.utcnow()-last_retrieved).seconds > 300) and not SECRET.get("no_from_ftp"):
                 log.info("Last retrieval too old, using FTP snapshots")
                 incorporate_ftp(mp)
@@ -242,25 +531,13 @@ if __name__ == "__main__":
 
             listener = None
             if not SECRET.get("no_listen_stomp"):
-                listener = Listener(mp)
-
-            tick = 0
-            while True:
-                tick += 1
-
-                if listener and (listener.is_disconnected() or listener.is_before_first_connection()):
-                    listener.connect_and_subscribe()
-
-                if tick % 3600 == 0:
-                    with db_connection.new_cursor() as c3:
-                        incorporate_reference_data(c3)
-
-                if tick % 3600 == 1:
-                    with db_connection.new_cursor() as c2:
-                        ironswallow.store.meta.renew_schedule_meta(c2)
+                listener = Listener(mp, SECRET.get("stomp_batch_size", 1), SECRET.get("stomp_batch_interval", 0),
+                                    SECRET.get("lag_minute_table", False), SECRET.get("stomp_prefetch_size"),
+                                    SECRET.get("database_queue_high_watermark", 500),
+                                    SECRET.get("database_queue_low_watermark", 100))
 
-                if tick % 30 == 0:
-                    if mp.count() > 500:
-                        log.info(f"Database queue count ({mp.count()}) over limit.")
+            if SECRET.get("meta_renew_on_start", True):
+                # Schedules only marked dirty before a restart would otherwise be left as they were
+                ironswallow.store.meta.mark_all_dirty()
 
-                sleep(1)
+            asyncio.run(service(mp, listener))
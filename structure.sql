@@ -60,6 +60,24 @@ CREATE TABLE last_received_sequence (
     time_acquired TIMESTAMP NOT NULL
 );
 
+-- Only written with lag_minute_table set
+CREATE TABLE darwin_lag (
+    minute TIMESTAMP NOT NULL PRIMARY KEY,
+    messages INTEGER NOT NULL,
+    p50 REAL,
+    p90 REAL,
+    p99 REAL,
+    max REAL,
+    sequence_gaps INTEGER NOT NULL,
+    sequence_missing INTEGER NOT NULL
+);
+
+-- Hash of the BPlan file last merged, so an unchanged one isn't merged again
+CREATE TABLE bplan_version (
+    sha256 CHAR(64) NOT NULL,
+    loaded TIMESTAMP NOT NULL
+);
+
 CREATE TABLE darwin_schedule_status (
     rid                   CHAR(15) NOT NULL,
     tiploc                VARCHAR(7),
@@ -0,0 +1,4 @@
+import os, sys
+
+# The repository isn't installed as a package, so tests import it from the checkout
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,106 @@
+import io
+from collections import OrderedDict
+
+import pytest
+
+from ironswallow.darwin import parse
+from ironswallow.darwin.parse import DarwinParser, DARWIN_PATHS, DARWIN_DETOKENISE, DARWIN_NAMED_LIST_PATHS
+
+
+def pport(body, update="uR") -> bytes:
+    return ('<?xml version="1.0" encoding="UTF-8"?><Pport xmlns="http://www.thalesgroup.com/rtti/PushPort/v16" '
+            'xmlns:ns3="http://www.thalesgroup.com/rtti/PushPort/Forecasts/v3" ts="2020-01-01T12:00:00.0000000Z" '
+            'version="16.0"><{0} updateOrigin="Darwin">{1}</{0}></Pport>'.format(update, body)).encode()
+
+
+MESSAGES = {
+    "schedule": pport('<schedule rid="202001017654321" uid="C12345" trainId="1A23" ssd="2020-01-01" toc="GW" '
+                      'trainCat="XX"><OR tpl="PADTON" act="TB" ptd="12:00" wtd="12:00"/>'
+                      '<IP tpl="RDNGSTN" act="T " plat="9" pta="12:25" ptd="12:27" wta="12:25" wtd="12:27"/>'
+                      '<PP tpl="DIDCTEJ" wtp="12:40:30"/><DT tpl="OXFD" act="TF" pta="12:55" wta="12:55"/>'
+                      '<cancelReason tiploc="OXFD" near="true">101</cancelReason></schedule>'),
+    "TS": pport('<TS rid="202001017654321" uid="C12345" ssd="2020-01-01"><ns3:LateReason tiploc="RDNGSTN">'
+                '102</ns3:LateReason><ns3:Location tpl="RDNGSTN" wta="12:25" wtd="12:27" pta="12:25" ptd="12:27">'
+                '<ns3:arr et="12:31" src="Darwin"/><ns3:dep et="12:33" src="Darwin" delayed="true"/>'
+                '<ns3:plat platsup="true" conf="true">9</ns3:plat></ns3:Location><ns3:Location tpl="DIDCTEJ" '
+                'wtp="12:40:30"><ns3:pass et="12:45"/></ns3:Location></TS>'),
+    "OW": pport('<OW id="1234" cat="Train" sev="1" suppress="false"><Station crs="PAD"/><Station crs="RDG"/>'
+                '<Msg>Disruption between <p>Reading and</p> <a href="http://example.com/travel">Oxford</a>, '
+                'trains may be delayed by up to 30 minutes.</Msg></OW>'),
+    "association": pport('<association tiploc="RDNGSTN" category="JJ"><main rid="202001017654321" wta="12:25" '
+                         'wtd="12:27"/><assoc rid="202001017654322" wta="12:26" wtd="12:27"/></association>'),
+    "formations": pport('<scheduleFormations rid="202001017654321"><formation fid="202001017654321-001" src="CIS">'
+                        '<coaches><coach coachNumber="A" coachClass="First"><toilet status="Unknown">Accessible'
+                        '</toilet></coach><coach coachNumber="B" coachClass="Standard"/><coach coachNumber="C" '
+                        'coachClass="Standard"/></coaches></formation></scheduleFormations>'),
+    "snapshot": pport('<schedule rid="202001017654322" uid="C12346" trainId="2B34" ssd="2020-01-01" toc="GW">'
+                      '<OR tpl="RDNGSTN" wtd="12:27"/><DT tpl="OXFD" wta="12:50"/></schedule>', update="sR"),
+}
+
+
+def chunked(data, size) -> list:
+    """data in pieces of around size bytes. A boundary next to whitespace would hand it over as a piece of its own,
+    which is stripped (see DarwinParser.parse_chunks), so those boundaries are moved along"""
+    chunks, start = [], 0
+    while start < len(data):
+        end = start + size
+        while end < len(data) and (data[end-1:end].isspace() or data[end:end+1].isspace()):
+            end += 1
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+def darwin_parser(**kwargs) -> DarwinParser:
+    return DarwinParser(DARWIN_PATHS, DARWIN_DETOKENISE, folded_list=DARWIN_NAMED_LIST_PATHS, **kwargs)
+
+
+@pytest.mark.parametrize("name", sorted(MESSAGES))
+def test_backends(name):
+    data = MESSAGES[name]
+    expected = darwin_parser().parse(io.BytesIO(data))
+
+    assert darwin_parser().parse_bytes(data) == expected
+    assert darwin_parser().parse_chunks(chunked(data, 16)) == expected
+    assert darwin_parser().parse_chunks(chunked(data, 1)) == expected
+    assert darwin_parser(record_types=parse.DARWIN_RECORD_TYPES).parse_bytes(data) == expected
+    assert parse.parse_pport(data) == expected["Pport"]
+    assert parse.parse_pport(data, dict, records=True) == expected["Pport"]
+
+    expected = DarwinParser(DARWIN_PATHS, DARWIN_DETOKENISE).parse(io.BytesIO(data))
+    assert parse.parse_xml(data) == expected
+    assert parse.parse_xml_chunks(chunked(data, 3)) == expected
+
+
+def test_pooled_reuse():
+    # The pooled parser is reset between messages, each result has to survive the ones parsed after it
+    results = [(name, parse.parse_pport(MESSAGES[name])) for name in sorted(MESSAGES) for _ in range(2)]
+    for name, result in results:
+        assert result == darwin_parser().parse(io.BytesIO(MESSAGES[name]))["Pport"]
+
+    first, second = [a for name, a in results if name == "TS"]
+    assert first is not second
+
+
+def test_parsed():
+    records = parse.parse_darwin(MESSAGES["schedule"])
+    assert [a["tag"] for a in records] == ["schedule"]
+    assert [a["tpl"] for a in records[0]["list"][:4]] == ["PADTON", "RDNGSTN", "DIDCTEJ", "OXFD"]
+    assert records[0]["list"][4]["$"] == "101"
+
+    ts = parse.parse_darwin(MESSAGES["TS"])[0]
+    assert [(a["tag"], a.get("tpl")) for a in ts["list"]] == [
+        ("LateReason", None), ("Location", "RDNGSTN"), ("Location", "DIDCTEJ")]
+    assert ts["list"][1]["plat"]["$"] == "9"
+
+    ow = parse.parse_darwin(MESSAGES["OW"])[0]
+    assert [a["crs"] for a in ow["list"] if a["tag"] == "Station"] == ["PAD", "RDG"]
+    message = [a["$"] for a in ow["list"] if a["tag"] == "Msg"][0]
+    assert message.startswith("Disruption between <p>Reading and</p>")
+    assert message.endswith('<a href="http://example.com/travel">Oxford</a>, trains may be delayed by up to 30 minutes.')
+
+    formation = parse.parse_darwin(MESSAGES["formations"])[0]["formation"]
+    assert [a["coachNumber"] for a in formation[0]["coaches"]["coach"]] == ["A", "B", "C"]
+
+    assert parse.pport_records(parse.parse_pport(MESSAGES["snapshot"]))[0]["rid"] == "202001017654322"
+    assert isinstance(parse.parse_pport(MESSAGES["TS"]), OrderedDict)
@@ -0,0 +1,68 @@
+import datetime, itertools
+from decimal import Decimal
+
+import pytest
+
+from ironswallow.util.times import day_rollover
+
+
+def compare_time(t1, t2) -> int:
+    # As store and query had it before day_rollover
+    if not (t1 and t2):
+        return 0
+    t1, t2 = [a.hour*3600+a.minute*60+a.second for a in (t1,t2)]
+    return (Decimal(t1)-Decimal(t2))/3600
+
+
+def old_rollover(time, previous) -> int:
+    if compare_time(time, previous) < -6:
+        return +1
+    elif -6 <= compare_time(time, previous) <= +18:
+        return 0
+    elif +18 < compare_time(time, previous):
+        return -1
+
+
+def time_of(seconds) -> datetime.time:
+    return datetime.time(seconds//3600, seconds//60 % 60, seconds % 60)
+
+
+# Every 7 minutes and 13 seconds, so the grid lands on all sorts of minutes and seconds
+GRID = [time_of(a) for a in range(0, 86400, 433)]
+
+
+def test_grid():
+    for time, previous in itertools.product(GRID, GRID):
+        assert day_rollover(time, previous) == old_rollover(time, previous), (time, previous)
+
+
+@pytest.mark.parametrize("boundary", [-6*3600, 18*3600])
+@pytest.mark.parametrize("offset", [-1, 0, 1])
+def test_edges(boundary, offset):
+    difference = boundary + offset
+    for previous in range(max(0, -difference), min(86400, 86400-difference), 997):
+        time, previous = time_of(previous+difference), time_of(previous)
+        assert day_rollover(time, previous) == old_rollover(time, previous), (time, previous)
+
+
+def test_missing():
+    assert day_rollover(None, datetime.time(12)) == 0
+    assert day_rollover(datetime.time(12), None) == 0
+
+
+def test_datetimes():
+    # Only the time of day counts, not the date
+    assert day_rollover(datetime.datetime(2020, 1, 1, 0, 10), datetime.datetime(2020, 3, 4, 23, 50)) == 1
+
+
+def test_combine_darwin_time():
+    pytest.importorskip("sqlalchemy")
+    from ironswallow.util.query import combine_darwin_time
+
+    working_time = datetime.datetime(2020, 1, 1, 23, 50)
+    assert combine_darwin_time(working_time, datetime.time(0, 10)) == datetime.datetime(2020, 1, 2, 0, 10)
+    assert combine_darwin_time(working_time, datetime.time(23, 55)) == datetime.datetime(2020, 1, 1, 23, 55)
+
+    working_time = datetime.datetime(2020, 1, 1, 0, 10)
+    assert combine_darwin_time(working_time, datetime.time(23, 50)) == datetime.datetime(2019, 12, 31, 23, 50)
+    assert combine_darwin_time(working_time, datetime.time(0, 5)) == datetime.datetime(2020, 1, 1, 0, 5)